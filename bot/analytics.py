@@ -0,0 +1,147 @@
+'''
+QC summaries over many runs, computed on columns of the run history.
+'''
+
+## To install numpy:
+# pip install numpy
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+QC_RUNS = 200 # runs per instrument summarized by default
+ROLLING_WINDOW = 20 # runs averaged by the rolling mean
+OUTLIER_SCORE = 3.5 # robust z-score above which a run is flagged
+PERCENTILES = (10, 50, 90)
+
+# Metrics summarized, as (history column, QC verdict column, label, scale)
+QC_METRICS = (('loading', 'loading_ok', 'Loading', 100),
+              ('usable', 'usable_ok', 'Usable', 100),
+              ('key_signal', 'key_signal_ok', 'Key signal', 1))
+
+
+class Columns:
+    '''
+    History samples as columnar arrays: one float array per metric, with NaN
+    where a run has no value, and label arrays to group by.
+    Chip types and QC verdicts are only known for runs whose details were read
+    (completed runs, or runs whose report was opened); the others have an
+    empty chip and NaN verdicts.
+    '''
+
+    def __init__(self, rows, names):
+        '''
+        :param rows: samples from HistoryStore, at most one per run.
+        :param names: dict of instrument id to display name.
+        '''
+        self.size = len(rows)
+        self.run_id = np.array([row['run_id'] for row in rows], dtype=np.int64)
+        self.instrument = np.array([names.get(row['instrument'], row['instrument'])
+                                    for row in rows], dtype=object)
+        self.chip = np.array([row['chip'] or '' for row in rows], dtype=object)
+        self.metrics = dict()
+        for column, verdict, _label, scale in QC_METRICS:
+            self.metrics[column] = np.array([row[column] for row in rows],
+                                            dtype=float) * scale
+            self.metrics[verdict] = np.array([row[verdict] for row in rows], dtype=float)
+
+
+def available():
+    return np is not None
+
+
+def qc_summary(rows, names, window=ROLLING_WINDOW):
+    '''
+    Return text blocks summarizing QC of many runs, per instrument and per chip type.
+    :param rows: samples from HistoryStore, at most one per run, oldest first.
+    :param names: dict of instrument id to display name.
+    :param window: number of runs averaged by the rolling mean.
+    '''
+    columns = Columns(rows, names)
+    blocks = ['QC of {} runs (pass rates only count runs with a QC verdict):'.format(
+              columns.size)]
+    for label, groups in (('instrument', columns.instrument), ('chip type', columns.chip)):
+        keys, index = np.unique(groups, return_inverse=True)
+        for position, key in enumerate(keys):
+            if not key:
+                continue
+            members = index == position
+            blocks.append('{} ({}, {} runs)\n{}'.format(
+                          key, label, int(members.sum()),
+                          '\n'.join(metric_lines(columns, members, window))))
+    unknown = int((columns.chip == '').sum())
+    if unknown:
+        blocks.append('{} runs without a chip type (their details were never read) '
+                      'are left out of the chip types.'.format(unknown))
+    for label, groups in (('instrument', columns.instrument), ('chip type', columns.chip)):
+        outliers = outlier_runs(columns, groups)
+        if outliers:
+            blocks.append('Outliers within their {}: {}'.format(label, ', '.join(outliers)))
+    return blocks
+
+
+def metric_lines(columns, members, window):
+    '''
+    Return one line per metric: pass rate among the runs with a QC verdict,
+    percentiles and latest rolling mean.
+    :param columns: a Columns instance.
+    :param members: boolean mask of the runs in the group.
+    :param window: number of runs averaged by the rolling mean.
+    '''
+    lines = []
+    for column, verdict, label, _scale in QC_METRICS:
+        values = columns.metrics[column][members]
+        values = values[~np.isnan(values)]
+        if not values.size:
+            continue
+        verdicts = columns.metrics[verdict][members]
+        verdicts = verdicts[~np.isnan(verdicts)]
+        if verdicts.size:
+            passed = 'pass {:.0%} ({} of {} runs with QC)'.format(
+                     verdicts.mean(), verdicts.size, values.size)
+        else:
+            passed = 'no QC verdict'
+        low, median, high = np.percentile(values, PERCENTILES)
+        lines.append('{}: {}, p{}-p{}-p{} {:.4g}/{:.4g}/{:.4g}, last {} mean {:.4g}'.format(
+                     label, passed, *PERCENTILES, low, median, high,
+                     min(window, values.size), rolling_mean(values, window)[-1]))
+    return lines or ['no metrics yet']
+
+
+def rolling_mean(values, window):
+    '''
+    Return the mean of each run and the (up to) `window` - 1 runs before it.
+    :param values: a float array without NaN.
+    '''
+    sums = np.cumsum(np.concatenate(([0.0], values)))
+    ends = np.arange(1, values.size + 1)
+    starts = np.maximum(ends - window, 0)
+    return (sums[ends] - sums[starts]) / (ends - starts)
+
+
+def outlier_runs(columns, groups):
+    '''
+    Return "instrument run (metric)" labels of runs whose metrics are far from
+    the median of their group, using the median absolute deviation.
+    Run IDs are only unique within an instrument, hence the instrument name.
+    :param columns: a Columns instance.
+    :param groups: group label of each run; runs labelled '' are left out.
+    '''
+    flagged = []
+    for column, _verdict, label, _scale in QC_METRICS:
+        values = columns.metrics[column]
+        score = np.zeros(columns.size)
+        for group in np.unique(groups):
+            if not group:
+                continue
+            members = (groups == group) & ~np.isnan(values)
+            if members.sum() < 3:
+                continue
+            median = np.median(values[members])
+            deviation = np.median(np.abs(values[members] - median))
+            if deviation:
+                score[members] = 0.6745 * (values[members] - median) / deviation
+        far = np.abs(score) > OUTLIER_SCORE
+        flagged.extend('{} {} ({})'.format(instrument, run_id, label) for instrument, run_id
+                       in zip(columns.instrument[far], columns.run_id[far]))
+    return flagged
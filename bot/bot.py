@@ -1,14 +1,25 @@
-import os, logging, time
-from threading import Timer
+import functools, os, logging, re, tempfile, threading, time
+from concurrent import futures
+from collections import OrderedDict
 ## To install the telegram module:
 # pip install python-telegram-bot
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
-from .config import BotConfig
-from .decorators import Usercheck
+from .config import BotConfig, DOWNLOADS_MAIN_DIR
+from .decorators import Usercheck, cleared
 from .chat import Chat
+from .uploads import FileIdCache
+from .jobs import JobQueue
+from .routing import RoutingTable
+from .scheduler import shared_scheduler, IntervalTrigger, CronTrigger, COALESCE
+from .outbox import Outbox, TICK, split_messages
+from . import analytics, export
 
 TICK_TIMER = 30 # minutes
+EVICTION_CRON = '0 4 * * *' # when the file cache drops old entries (daily at 04:00)
+HISTORY_RUNS = 30 # runs listed by /history by default
+MARKUP_CACHE_SIZE = 256 # serialized keyboards kept in memory
+OVERVIEW_TIMEOUT = 15 # seconds to wait for each server in the all-instruments overview
 
 class Mainloop:
     '''
@@ -17,12 +28,28 @@ class Mainloop:
     
     def __init__(self):
         self.starttime = time.time()
-        self.rt = dict() # {id: RepeatTimer()}
+        self.scheduler = shared_scheduler()
+        self.ticks = dict() # {id: ScheduledJob}
+        self.ticks_lock = threading.Lock()
         self.chats = {}
+        self.chats_lock = threading.Lock()
+        self.routing = RoutingTable() # built on the first button press
+        self.markups = OrderedDict() # {(status, role, context, version): serialized markup}
+        self.markups_lock = threading.Lock()
+        self.markup_hits = 0
+        self.markup_misses = 0
+        self.routing_lock = threading.Lock()
         self.cfg = BotConfig(self)
         if not self.cfg.ok:
             print('Configurations could not be loaded. Ending the script.')
             os._exit(0)
+        self.outbox = Outbox()
+        self.jobs = JobQueue() # slow requests, e.g. run reports
+        self.overview_pool = futures.ThreadPoolExecutor(max_workers=len(self.cfg.instr))
+        self.uploads = FileIdCache(os.path.join(DOWNLOADS_MAIN_DIR, 'file_ids.json'),
+                                   self.outbox)
+        self.scheduler.schedule(CronTrigger(EVICTION_CRON), self.cfg.artifacts.expire,
+                                name='cache eviction', missed=COALESCE)
 
         # Keyboard buttons, based on status
         self.keyboards = {'administration': [[InlineKeyboardButton("Administration", callback_data='A')]],
@@ -30,7 +57,9 @@ class Mainloop:
                                     InlineKeyboardButton("Stop ticking", callback_data='U')],
                                     [InlineKeyboardButton("View queue", callback_data='Q'),
                                     InlineKeyboardButton("Download log", callback_data='L')],
-                                    [InlineKeyboardButton("Kill the bot", callback_data='K')]],
+                                    [InlineKeyboardButton("Statistics", callback_data='S'),
+                                    InlineKeyboardButton("Kill the bot", callback_data='K')]],
+                          'overview': [[InlineKeyboardButton("All instruments", callback_data='O')]],
                           'exit': [[InlineKeyboardButton("Exit", callback_data='E')]],
                           'back': [[InlineKeyboardButton("Back", callback_data='B')]],
                           'instr': []
@@ -41,7 +70,8 @@ class Mainloop:
                                            callback_data=instrument)])  
 
         # Create updater and dispatcher
-        self.updater = Updater(token=self.cfg.config['NETWORK']['token'])
+        self.updater = Updater(token=self.cfg.config['NETWORK']['token'],
+                               workers=int(self.cfg.config['NETWORK']['workers']))
         dispatcher = self.updater.dispatcher
 
         # register basic handlers
@@ -51,6 +81,13 @@ class Mainloop:
         dispatcher.add_handler(CommandHandler('untick', self.untick))
         dispatcher.add_handler(CommandHandler('join', self.join))
         dispatcher.add_handler(CommandHandler('log', self.send_log))
+        dispatcher.add_handler(CommandHandler('stats', self.stats))
+        dispatcher.add_handler(CommandHandler('export', self.export, pass_args=True))
+        dispatcher.add_handler(CommandHandler('overview', self.overview))
+        dispatcher.add_handler(CommandHandler('history', self.history, pass_args=True))
+        dispatcher.add_handler(CommandHandler('qc', self.qc, pass_args=True))
+        dispatcher.add_handler(CommandHandler('subscribe', self.subscribe, pass_args=True))
+        dispatcher.add_handler(CommandHandler('unsubscribe', self.unsubscribe, pass_args=True))
         dispatcher.add_handler(CommandHandler('bye', self.bye))
         dispatcher.add_handler(CallbackQueryHandler(self.button))
 
@@ -72,136 +109,254 @@ class Mainloop:
         user = update.effective_user
         if user.id not in self.chats:
             self.newchat(user)
+        self.routes().dispatch(bot, update, query.data)
+
+
+    def routes(self):
+        '''
+        Return the RoutingTable for button events, rebuilding it only if an
+        instrument replaced its keyboard since it was built.
+        '''
+        version = tuple((instr_id, id(handler.keyboard), id(handler.families))
+                        for instr_id, handler in sorted(self.cfg.instr.items()))
+        with self.routing_lock:
+            if self.routing.version != version:
+                self.routing = self.build_routes(version)
+            return self.routing
+
+
+    def build_routes(self, version):
+        '''
+        Build a RoutingTable for every button the bot offers.
+        :param version: the keyboards the table is built from; see self.routes().
+        '''
+        table = RoutingTable(version, self.routing.hits)
         # In all of the following cases, execute the relative function.
-        sender = {'A': self.admin,
-                  'L': self.send_log,
-                  'Q': self.join,
-                  'K': self.killwarning,
-                  'T': self.tick,
-                  'U': self.untick,
-                  'E': self.bye,
-                  'B': self.start}
-                  
-        if query.data in sender:
-            sender[query.data](bot, update)
-        
+        sender = [('A', 'admin', self.admin),
+                  ('L', 'log', self.send_log),
+                  ('Q', 'join', self.join),
+                  ('K', 'kill', self.killwarning),
+                  ('S', 'stats', self.stats),
+                  ('T', 'tick', self.tick),
+                  ('U', 'untick', self.untick),
+                  ('E', 'bye', self.bye),
+                  ('O', 'overview', self.overview),
+                  ('B', 'back', self.start)]
+        for callback_data, name, method in sender:
+            table.add(callback_data, name,
+                      lambda bot, update, _data, method=method: method(bot, update),
+                      functools.partial(self.accepts, method))
         # Handle user approval and denial
-        elif query.data.startswith("App_"):
-            app_username = query.data[4:]
-            self.approve(bot, update, app_username)
-        
-        elif query.data.startswith("Blo_"):
-            block_username = query.data[4:]
-            self.block(bot, update, block_username)
-        
-        # Handle main instrument buttons
-        elif query.data in self.cfg.instr.keys():
-            self.chats[user.id].set_status('instr', instr=query.data)
-            bot.sendMessage(chat_id=user.id, text='Entering {} menu.'.format(\
-                            self.cfg.config[query.data]['name']))
+        table.add_family('App_', 'approve',
+                         lambda bot, update, data: self.approve(bot, update, data[4:]),
+                         functools.partial(self.accepts, self.approve))
+        table.add_family('Blo_', 'block',
+                         lambda bot, update, data: self.block(bot, update, data[4:]),
+                         functools.partial(self.accepts, self.block))
+        table.add_family('Pin_', 'pin', self.pin_button)
+        for instr_id, handler in self.cfg.instr.items():
+            # Handle main instrument buttons
+            table.add(instr_id, 'instrument', self.enter_instrument)
+            # Handle instrument-specific buttons
+            for _button_name, method, local_callback_data in handler.keyboard:
+                full_callback_data = instr_id + '_' + local_callback_data
+                table.add(full_callback_data, full_callback_data,
+                          functools.partial(self.instrument_button, instr_id, method),
+                          functools.partial(self.accepts, method, instr_id=instr_id))
+            for prefix, method in handler.families:
+                table.add_family(instr_id + '_' + prefix, instr_id + '_' + prefix + '*',
+                                 functools.partial(self.instrument_button, instr_id, method),
+                                 functools.partial(self.accepts, method, instr_id=instr_id))
+        return table
+
+
+    def accepts(self, method, bot, update, callback_data, instr_id=None):
+        '''
+        Return whether a button press will be acted upon, rather than refused
+        or ignored; used by the routes to count hits.
+        :param method: the method the button calls, possibly decorated by Usercheck.
+        :param instr_id: for instrument buttons, the instrument they belong to.
+        '''
+        user = update.effective_user
+        if not cleared(self.cfg, user.username, getattr(method, 'userlevel', 'any')):
+            return False
+        if instr_id is None:
+            return True
+        # Buttons of a menu the chat has left are stale
+        chat = self.chats.get(user.id)
+        return chat is not None and chat.status == 'instr' and chat.context == instr_id
+
+
+    def enter_instrument(self, bot, update, instr_id):
+        user = update.effective_user
+        self.chats[user.id].set_status('instr', instr=instr_id)
+        self.outbox.send(bot.sendMessage, chat_id=user.id, text='Entering {} menu.'.format(\
+                        self.cfg.config[instr_id]['name']))
+        self.keyboard(bot, update)
+
+
+    def instrument_button(self, instr_id, method, bot, update, callback_data):
+        '''
+        Run an instrument-specific method, if the chat is within that instrument's menu.
+        :param instr_id: the instrument the button belongs to.
+        :param method: the Handler method listed for the button.
+        :param callback_data: the full callback_data; the method gets it without `instr_id`.
+        '''
+        user = update.effective_user
+        chat = self.chats[user.id]
+        if chat.status != 'instr' or chat.context != instr_id:
+            return
+        next_status = method(bot, update, callback_data[len(instr_id) + 1:])
+        chat.set_status(next_status)
+        self.keyboard(bot, update)
+
+
+    def pin_button(self, bot, update, callback_data):
+        '''
+        Handle PIN inline keyboard events.
+        '''
+        user = update.effective_user
+        pin_digit = callback_data[4]
+        message, to_keyboard, action = self.chats[user.id].handle_pin(\
+                pin_digit=pin_digit, cfg_sha=self.cfg.users[user.username][0])
+        if action == 'update_cfg':
+            # This will keep updated both self.cfg.users and self.cfg.admins
+            self.cfg.users[user.username][0] = self.chats[user.id].sha
+            self.chats[user.id].set_sha(None)
+            self.cfg.save_config()
+        elif action == 'user_to_queue':
+            self.cfg.users.pop(user.username)
+            if user.username in self.cfg.admins:
+                self.cfg.admins.pop(user.username)
+            self.cfg.queue.add(user.username)
+            self.save_config()
+            logging.info("User {} has been returned to the queue "
+                         "for failing 3 authentication attempts.".format(\
+                                 user.username))
+        if message != '':
+            self.outbox.send(bot.sendMessage, chat_id=user.id, text=message)
+        if to_keyboard:
             self.keyboard(bot, update)
-            
-        # Handle instrument-specific buttons
-        elif self.chats[user.id].status == 'instr':
-            context = self.chats[user.id].context
-            instr_handler = self.cfg.instr[context]
-            # Might be changeable, so needs to be redone each time
-            command = dict()
-            for _button_name, method, local_callback_data in instr_handler.keyboard:
-                full_callback_data = context + '_' + local_callback_data
-                command[full_callback_data] = [method, local_callback_data]
-            if query.data in command.keys():
-                # Ugly but works
-                next_status = command[query.data][0](bot, update, command[query.data][1])
-                self.chats[user.id].set_status(next_status)
-                self.keyboard(bot, update)
-            
-        # Handle PIN inline keyboard events
-        elif query.data.startswith("Pin_"):
-            pin_digit = query.data[4]
-            message, to_keyboard, action = self.chats[user.id].handle_pin(\
-                    pin_digit=pin_digit, cfg_sha=self.cfg.users[user.username][0])
-            if action == 'update_cfg':
-                # This will keep updated both self.cfg.users and self.cfg.admins
-                self.cfg.users[user.username][0] = self.chats[user.id].sha
-                self.chats[user.id].set_sha(None)
-                self.cfg.save_config()
-            elif action == 'user_to_queue':
-                self.cfg.users.pop(user.username)
-                if user.username in self.cfg.admins:
-                    self.cfg.admins.pop(user.username)
-                self.cfg.queue.add(user.username)
-                self.save_config()
-                logging.info("User {} has been returned to the queue "
-                             "for failing 3 authentication attempts.".format(\
-                                     user.username))
-            if message != '':
-                bot.sendMessage(chat_id=user.id, text=message)
-            if to_keyboard:
-                self.keyboard(bot, update)
-            
 
 
-            
     def keyboard(self, bot, update):
         '''
         Offer command options to the user, based on the user's current status.
         :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
         :param update: the received update, automatically informed by python-telegram-bot.
         '''
-        keyboard = []
         user = update.effective_user
         text = "Choose an action:                    "
         status = self.chats[user.id].status
         context = self.chats[user.id].context
-        markup = InlineKeyboardMarkup
+        role = self.role(user.username)
         if status == 'start':
+            if role == 'waiting':
+                return
             text = "How can I help you, {}?".format(user.first_name)
-            if user.username in self.cfg.admins:
+        if status == 'join' and role == 'admin':
+            text = "Approve or block these users:"
+        if status == 'admin':
+            text = "Entering admin menu."
+        if status in ('newpin', 'pincheck'):
+            text = "Please enter your PIN using the following buttons:"
+        reply_markup = self.markup(status, role, context, user.id)
+        self.outbox.send(bot.sendMessage, chat_id=user.id, text=text, reply_markup=reply_markup)
+
+
+    def role(self, username):
+        '''
+        Return 'admin', 'user', 'waiting' (queued or blocked) or 'guest'.
+        '''
+        if username in self.cfg.admins:
+            return 'admin'
+        if username in self.cfg.users:
+            return 'user'
+        if username in self.cfg.blocked or username in self.cfg.queue:
+            return 'waiting'
+        return 'guest'
+
+
+    def markup(self, status, role, context, chat_id):
+        '''
+        Return the serialized InlineKeyboardMarkup for a chat. Markups are kept for up
+        to MARKUP_CACHE_SIZE keys of (status, role, instrument context, keyboard
+        version); the version is the queue of users for 'join' and the chat's view
+        of the instrument for 'instr', so changes to either select a new markup.
+        :param status: the chat's status.
+        :param role: the user's role, as returned by self.role().
+        :param context: the chat's instrument context.
+        :param chat_id: the user's chat.
+        '''
+        buttons = ()
+        if status == 'join' and role == 'admin':
+            version = frozenset(self.cfg.queue)
+        elif status == 'instr':
+            version, buttons = self.cfg.instr[context].view(chat_id)
+        else:
+            version = None
+        key = (status, role, context if status == 'instr' else None, version)
+        with self.markups_lock:
+            payload = self.markups.get(key)
+            if payload is not None:
+                self.markups.move_to_end(key)
+                self.markup_hits += 1
+                return payload
+            self.markup_misses += 1
+        keyboard = self.keyboard_rows(status, role, context, buttons)
+        # python-telegram-bot sends a string reply_markup as is
+        payload = InlineKeyboardMarkup(keyboard).to_json()
+        with self.markups_lock:
+            self.markups[key] = payload
+            if len(self.markups) > MARKUP_CACHE_SIZE:
+                self.markups.popitem(last=False)
+        return payload
+
+
+    def keyboard_rows(self, status, role, context, buttons):
+        '''
+        Build the rows of InlineKeyboardButtons for a chat; see self.markup().
+        :param buttons: the instrument's buttons, for status 'instr'.
+        '''
+        keyboard = []
+        if status == 'start':
+            if role == 'admin':
                 keyboard.extend(self.keyboards['administration'])
-            if user.username in self.cfg.users:
+            if role in ('admin', 'user'):
                 keyboard.extend(self.keyboards['instr'])
+                if len(self.cfg.instr) > 1:
+                    keyboard.extend(self.keyboards['overview'])
                 keyboard.extend(self.keyboards['exit'])
-            elif user.username in self.cfg.blocked or user.username in self.cfg.queue:
-                return
             else:
                 keyboard.append([InlineKeyboardButton("Join queue",
                                                           callback_data='Q')])
 
-        if status == 'join':
-            if user.username in self.cfg.admins:
-                text = "Approve or block these users:"
-                for queued in self.cfg.queue:
-                    keyboard.append([InlineKeyboardButton("Approve "+queued, 
-                                                          callback_data='App_'+queued),
-                                     InlineKeyboardButton("Block", 
-                                                          callback_data='Blo_'+queued)])
+        if status == 'join' and role == 'admin':
+            for queued in sorted(self.cfg.queue):
+                keyboard.append([InlineKeyboardButton("Approve "+queued, 
+                                                      callback_data='App_'+queued),
+                                 InlineKeyboardButton("Block", 
+                                                      callback_data='Blo_'+queued)])
         
         if status == 'instr':
-            instr_handler = self.cfg.instr[context]
-            # Might be changeable, so needs to be redone each time
-            for button_name, _method, callback_data in instr_handler.keyboard:
+            for button_name, _method, callback_data in buttons:
                 keyboard.append([InlineKeyboardButton(button_name,
                         callback_data=context+'_'+callback_data)])
 
         if status == 'admin':
-            text = "Entering admin menu."
             keyboard.extend(self.keyboards['admin'])
 
         if status == 'back' or status not in ('start', 'newpin', 'pincheck'):
             keyboard.extend(self.keyboards['back'])
         
         if status in ('newpin', 'pincheck'):
-            text = "Please enter your PIN using the following buttons:"
             for row in range(2):
                 keyboard.append([])
                 for number in range(5):
                     strnum = str(5 * row + number)
                     keyboard[-1].append(InlineKeyboardButton(strnum,
                                                               callback_data='Pin_'+strnum))
-            
-        reply_markup = markup(keyboard)
-        bot.sendMessage(chat_id=user.id, text=text, reply_markup=reply_markup)
+        return keyboard
 
 
     def newchat(self, user):
@@ -209,7 +364,10 @@ class Mainloop:
         Add a new chat to the dictionary of chats.
         :param user: telegram.User object for the current user.
         '''
-        self.chats[user.id] = Chat(user)
+        with self.chats_lock:
+            if user.id in self.chats:
+                return
+            self.chats[user.id] = Chat(user)
         logging.info("Initiated chat with user: {}".format(user.username))
 
        
@@ -220,7 +378,7 @@ class Mainloop:
         :param update: the received update, automatically informed by python-telegram-bot.
         '''
         user = update.effective_user
-        bot.sendMessage(chat_id=user.id, text="Please choose a 4-digit PIN.")
+        self.outbox.send(bot.sendMessage, chat_id=user.id, text="Please choose a 4-digit PIN.")
         self.chats[user.id].set_status('newpin')
         self.keyboard(bot, update)
         
@@ -232,7 +390,7 @@ class Mainloop:
         :param update: the received update, automatically informed by python-telegram-bot.
         '''
         user = update.effective_user
-        bot.sendMessage(chat_id=user.id, text="Please enter your PIN.")
+        self.outbox.send(bot.sendMessage, chat_id=user.id, text="Please enter your PIN.")
         self.chats[user.id].set_status('pincheck')
         self.keyboard(bot, update)
         
@@ -248,22 +406,22 @@ class Mainloop:
         '''
         user = update.effective_user
         if user.username in self.cfg.queue:
-            bot.sendMessage(chat_id=user.id, 
+            self.outbox.send(bot.sendMessage, chat_id=user.id, 
                     text="Hello, {}. You are already in the queue.".format(user.username))
             self.chats[user.id].set_status('start')
         elif user.username not in self.cfg.users:
             self.chats[user.id].set_status('join')
             self.cfg.queue.add(user.username)
             self.save_config()
-            bot.sendMessage(chat_id=user.id, 
+            self.outbox.send(bot.sendMessage, chat_id=user.id, 
                     text="You have been added to the queue, {}.".format(user.username))
             
         else:
             if not self.cfg.queue:
-                bot.sendMessage(chat_id=user.id, text="There are no users in the queue.")
+                self.outbox.send(bot.sendMessage, chat_id=user.id, text="There are no users in the queue.")
                 self.chats[user.id].set_status('start')
             else:
-                bot.sendMessage(chat_id=user.id, 
+                self.outbox.send(bot.sendMessage, chat_id=user.id, 
                         text="The following users are in the queue:\n" + \
                         ''.join(['@{}\n'.format(name) for name in self.cfg.queue]))
                 self.chats[user.id].set_status('join')
@@ -286,7 +444,7 @@ class Mainloop:
         
         # If the user is still in the queue, inform him/her
         elif user.username in self.cfg.queue:
-                bot.sendMessage(chat_id=user.id, 
+                self.outbox.send(bot.sendMessage, chat_id=user.id, 
                                 text="Hello, {}. I'm afraid you haven't been "
                                 "cleared from the queue yet. Please speak to "
                                 "an administrator to get clearance.".format(
@@ -294,7 +452,7 @@ class Mainloop:
         
         # If it's a new user, greet him/her
         else:
-            bot.sendMessage(chat_id=user.id, 
+            self.outbox.send(bot.sendMessage, chat_id=user.id, 
                             text=self.cfg.config['MESSAGES']['start'])
         self.chats[user.id].set_status('start')
         self.keyboard(bot, update)
@@ -309,10 +467,135 @@ class Mainloop:
         '''
         user = update.effective_user
         self.chats[user.id].set_status('bye')
-        bot.sendMessage(chat_id=user.id, 
+        self.outbox.send(bot.sendMessage, chat_id=user.id, 
                         text="Goodbye, {}. Type /start to restart.".format(user.first_name))
 
 
+    @Usercheck('user')
+    def overview(self, bot, update):
+        '''
+        Summarize the runs on every instrument, querying all servers at once.
+        Servers that do not answer within OVERVIEW_TIMEOUT seconds are marked as such.
+        :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
+        :param update: the received update, automatically informed by python-telegram-bot.
+        '''
+        user = update.effective_user
+        instruments = sorted(self.cfg.instr.items())
+        pending = [self.overview_pool.submit(handler.overview) for _id, handler in instruments]
+        futures.wait(pending, timeout=OVERVIEW_TIMEOUT)
+        blocks = []
+        for (instr_id, _handler), future in zip(instruments, pending):
+            if future.done() and future.exception() is None:
+                blocks.append(future.result())
+            else:
+                blocks.append('{}: no answer within {}s'.format(
+                              self.cfg.config[instr_id]['name'], OVERVIEW_TIMEOUT))
+        for text in split_messages(blocks):
+            self.outbox.send(bot.sendMessage, chat_id=user.id, text=text)
+        self.chats[user.id].set_status('start')
+        self.keyboard(bot, update)
+
+
+    @Usercheck('user')
+    def history(self, bot, update, args):
+        '''
+        Show stored metrics of the current instrument, without contacting its server.
+        Usage: /history (last runs), /history last <number of runs>, /history <run ID>
+        :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
+        :param update: the received update, automatically informed by python-telegram-bot.
+        :param args: the command's arguments, automatically informed by python-telegram-bot.
+        '''
+        user = update.effective_user
+        context = self.chats[user.id].context
+        if context not in self.cfg.instr:
+            blocks = ["Please choose an instrument first."]
+        elif len(args) == 1 and args[0].isdigit():
+            samples = self.cfg.history.run_history(context, int(args[0]))
+            blocks = ['History of run {}:'.format(args[0])]
+            blocks.extend('{} {}: {}'.format(time.strftime('%Y-%m-%d %H:%M',
+                                                           time.localtime(sample['taken'])),
+                                             sample['status'], history_metrics(sample))
+                          for sample in samples)
+            if not samples:
+                blocks = ["No data stored for run {}.".format(args[0])]
+        elif not args or (len(args) == 2 and args[0] == 'last' and args[1].isdigit()):
+            count = int(args[1]) if args else HISTORY_RUNS
+            samples = self.cfg.history.last_runs(context, count)
+            blocks = ['Last {} runs on {}:'.format(len(samples),
+                                                   self.cfg.config[context]['name'])]
+            blocks.extend('[{}] {}: {}'.format(sample['run_id'], sample['name'],
+                                               history_metrics(sample))
+                          for sample in samples)
+            if not samples:
+                blocks = ["No data stored yet."]
+        else:
+            blocks = ["Usage: /history, /history last <number of runs> or /history <run ID>"]
+        for text in split_messages(blocks, separator='\n'):
+            self.outbox.send(bot.sendMessage, chat_id=user.id, text=text)
+
+
+    @Usercheck('user')
+    def qc(self, bot, update, args):
+        '''
+        Summarize QC of the last runs of every instrument, from the stored history.
+        Usage: /qc [number of runs per instrument]
+        :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
+        :param update: the received update, automatically informed by python-telegram-bot.
+        :param args: the command's arguments, automatically informed by python-telegram-bot.
+        '''
+        user = update.effective_user
+        if not analytics.available():
+            blocks = ["QC summaries need the numpy library, which is not installed."]
+        elif args and not (len(args) == 1 and args[0].isdigit()):
+            blocks = ["Usage: /qc [number of runs per instrument]"]
+        else:
+            count = int(args[0]) if args else analytics.QC_RUNS
+            rows = []
+            for instr_id in sorted(self.cfg.instr):
+                rows.extend(self.cfg.history.last_runs(instr_id, count))
+            names = {instr_id: self.cfg.config[instr_id]['name'] for instr_id in self.cfg.instr}
+            blocks = analytics.qc_summary(rows, names) if rows else ["No data stored yet."]
+        for text in split_messages(blocks):
+            self.outbox.send(bot.sendMessage, chat_id=user.id, text=text)
+
+
+    @Usercheck('user')
+    def subscribe(self, bot, update, args):
+        '''
+        Get notified of changes on the current instrument, or to one of its runs.
+        Usage: /subscribe [run ID]
+        :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
+        :param update: the received update, automatically informed by python-telegram-bot.
+        :param args: the command's arguments, automatically informed by python-telegram-bot.
+        '''
+        self.change_subscription(bot, update, args, 'subscribe')
+
+
+    @Usercheck('user')
+    def unsubscribe(self, bot, update, args):
+        '''
+        Stop notifications for the current instrument, or for one of its runs.
+        Usage: /unsubscribe [run ID]
+        :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
+        :param update: the received update, automatically informed by python-telegram-bot.
+        :param args: the command's arguments, automatically informed by python-telegram-bot.
+        '''
+        self.change_subscription(bot, update, args, 'unsubscribe')
+
+
+    def change_subscription(self, bot, update, args, action):
+        user = update.effective_user
+        context = self.chats[user.id].context
+        if context not in self.cfg.instr:
+            text = "Please choose an instrument first."
+        elif args and not args[0].isdigit():
+            text = "Usage: /{} [run ID]".format(action)
+        else:
+            run_id = int(args[0]) if args else None
+            text = getattr(self.cfg.instr[context], action)(user.id, run_id)
+        self.outbox.send(bot.sendMessage, chat_id=user.id, text=text)
+
+
     @Usercheck('admin')
     def admin(self, bot, update):
         '''
@@ -337,7 +620,7 @@ class Mainloop:
         self.cfg.users[username] = [None]
         self.cfg.queue.remove(username)
         self.save_config()
-        bot.sendMessage(chat_id=user.id, 
+        self.outbox.send(bot.sendMessage, chat_id=user.id, 
                 text="User {} has been approved.".format(username))
         self.keyboard(bot, update)
     
@@ -354,7 +637,7 @@ class Mainloop:
         self.cfg.blocked.add(username)
         self.cfg.queue.remove(username)
         self.save_config()
-        bot.sendMessage(chat_id=user.id, 
+        self.outbox.send(bot.sendMessage, chat_id=user.id, 
                 text="User {} has been blocked.".format(username))
         self.keyboard(bot, update)
 
@@ -367,8 +650,14 @@ class Mainloop:
         :param update: the received update, automatically informed by python-telegram-bot.
         '''
         user = update.effective_user
-        bot.sendMessage(chat_id=user.id, 
+        farewell = self.outbox.send(bot.sendMessage, chat_id=user.id, 
                         text=self.cfg.config['MESSAGES']['kill'])
+        try:
+            farewell.result(timeout=10)
+        except Exception:
+            pass
+        # Cache hits are only saved from time to time
+        self.cfg.artifacts.flush()
         #self.updater.stop() # is just not working to stop the script
         os._exit(0)
 
@@ -376,7 +665,7 @@ class Mainloop:
     @Usercheck('admin')
     def killwarning(self, bot, update):
         user = update.effective_user
-        bot.sendMessage(chat_id=user.id, 
+        self.outbox.send(bot.sendMessage, chat_id=user.id, 
                         text="Please use the command /kill to stop the bot.")
 
 
@@ -384,9 +673,95 @@ class Mainloop:
     def send_log(self, bot, update):
         user = update.effective_user
         with open('IonWatcher.log', 'rb') as document:
-            bot.sendDocument(chat_id=user.id, document=document, filename='IonWatcher.log.txt')
+            # Wait until sent, as the file is closed afterwards
+            self.outbox.call(bot.sendDocument, chat_id=user.id, document=document,
+                             filename='IonWatcher.log.txt')
 
         
+    @Usercheck('admin')
+    def export(self, bot, update, args):
+        '''
+        Send the stored metrics of the current instrument as a compressed CSV or Parquet file.
+        Usage: /export [START [END]] [csv|parquet], with dates as YYYY-MM-DD (END included)
+        :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
+        :param update: the received update, automatically informed by python-telegram-bot.
+        :param args: the command's arguments, automatically informed by python-telegram-bot.
+        '''
+        user = update.effective_user
+        context = self.chats[user.id].context
+        fmt = args.pop() if args and args[-1] in export.FORMATS else 'csv'
+        try:
+            days = [time.mktime(time.strptime(day, '%Y-%m-%d')) for day in args]
+        except ValueError:
+            days = None
+        if days is None or len(days) > 2:
+            error = ("Usage: /export [START [END]] [csv|parquet]\n"
+                     "START and END are dates as YYYY-MM-DD; END is included.")
+        elif context not in self.cfg.instr:
+            error = "Please choose an instrument first."
+        elif fmt == 'parquet' and export.pyarrow is None:
+            error = "Parquet exports need the pyarrow library, which is not installed."
+        else:
+            error = None
+        if error:
+            self.outbox.send(bot.sendMessage, chat_id=user.id, text=error)
+            return
+        start = days[0] if days else None
+        # Days are in local time; the end day is included
+        end = days[1] + 24 * 60 * 60 if len(days) == 2 else None
+        filename = '{}_metrics.{}'.format(re.sub(r'\W+', '_', self.cfg.config[context]['name']),
+                                          'csv.gz' if fmt == 'csv' else 'parquet')
+        with tempfile.TemporaryFile() as document:
+            export.export(self.cfg.history, context, document, fmt, start, end)
+            document.seek(0)
+            # Wait until sent, as the file is closed afterwards
+            self.outbox.call(bot.sendDocument, chat_id=user.id, document=document,
+                             filename=filename)
+
+
+    @Usercheck('admin')
+    def stats(self, bot, update):
+        '''
+        Send performance statistics for every instrument.
+        :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
+        :param update: the received update, automatically informed by python-telegram-bot.
+        '''
+        user = update.effective_user
+        text = []
+        for instr_id, handler in sorted(self.cfg.instr.items()):
+            text.append('[{}] {}'.format(instr_id, self.cfg.config[instr_id]['name']))
+            text.extend(handler.stats() or ['No connections yet.'])
+        cache = self.cfg.artifacts.stats()
+        text.append('File cache: {} files, {:.1f} MB, {} hits, {} revalidated, '
+                    '{} downloads'.format(cache['entries'], cache['bytes'] / 1024 / 1024,
+                                          cache['hits'], cache['revalidated'],
+                                          cache['downloads']))
+        uploads = self.uploads.stats()
+        text.append('Telegram uploads: {} files uploaded, {} sent by file_id'.format(
+                    uploads['uploads'], uploads['hits']))
+        outbox = self.outbox.stats()
+        text.append('Outbox: {} queued, {} sent, {} flood retries, wait {:.2f}s mean, '
+                    '{:.2f}s max'.format(outbox['queued'], outbox['sent'],
+                                         outbox['retries'], outbox['mean_wait'],
+                                         outbox['max_wait']))
+        text.append('Keyboards: {} cached, {} hits, {} misses'.format(
+                    len(self.markups), self.markup_hits, self.markup_misses))
+        scheduler = self.scheduler.stats()
+        text.append('Scheduler: {} jobs, {} runs, {} missed, {:.2f}s max delay'.format(
+                    scheduler['jobs'], scheduler['runs'], scheduler['misses'],
+                    scheduler['max_delay']))
+        routes = self.routes().stats()
+        text.append('Buttons: {} routes; most pressed: {}'.format(routes['routes'],
+                    ', '.join('{} ({})'.format(name, hits) for name, hits in routes['hits'])
+                    or 'none yet'))
+        jobs = self.jobs.stats()
+        text.append('Report jobs: {} pending, {} done, {} cancelled, {} failed, {} refused; '
+                    'wait {:.2f}s mean, total {:.2f}s mean, {:.2f}s max'.format(
+                    jobs['pending'], jobs['completed'], jobs['cancelled'], jobs['failed'],
+                    jobs['refused'], jobs['mean_wait'], jobs['mean_time'], jobs['max_time']))
+        self.outbox.send(bot.sendMessage, chat_id=user.id, text='\n'.join(text))
+
+
     @Usercheck('admin')
     def tick(self, bot, update):
         '''
@@ -396,13 +771,17 @@ class Mainloop:
         :param update: the received update, automatically informed by python-telegram-bot.
         '''
         user = update.effective_user
-        if user.id not in self.rt.keys():
-            self.rt[user.id] = RepeatedTimer(TICK_TIMER * 60, self.send_tick, bot, user)
-            bot.sendMessage(chat_id=user.id, 
+        with self.ticks_lock:
+            started = user.id not in self.ticks
+            if started:
+                # Ticks only keep the bot reachable, so missed ones are not worth catching up
+                self.ticks[user.id] = self.scheduler.schedule(
+                        IntervalTrigger(TICK_TIMER * 60), self.send_tick, args=(bot, user),
+                        name='tick-{}'.format(user.id), missed=COALESCE)
+        if started:
+            self.outbox.send(bot.sendMessage, chat_id=user.id, 
                             text=self.cfg.config['MESSAGES']['tick'])        
-            self.send_tick(bot, user)
-        else:
-            self.send_tick(bot, user)
+        self.send_tick(bot, user)
 
         
     @Usercheck('admin')
@@ -413,10 +792,11 @@ class Mainloop:
         :param update: the received update, automatically informed by python-telegram-bot.
         '''
         user = update.effective_user
-        if user.id in self.rt.keys():
-            self.rt[user.id].stop()
-            gone = self.rt.pop(user.id)
-            bot.sendMessage(chat_id=user.id, 
+        with self.ticks_lock:
+            job = self.ticks.pop(user.id, None)
+        if job is not None:
+            job.cancel()
+            self.outbox.send(bot.sendMessage, chat_id=user.id, 
                             text=self.cfg.config['MESSAGES']['untick'])
     
 
@@ -429,51 +809,19 @@ class Mainloop:
         delta = time.time() - self.starttime
         days, remainder = divmod(delta, 60*60*24)
         hms = time.strftime('%H:%M:%S', time.gmtime(remainder))
-        bot.sendMessage(chat_id=user.id,
-                        text="Bot uptime: {} days {}".format(days, hms))
+        self.outbox.send(bot.sendMessage, priority=TICK, chat_id=user.id,
+                         text="Bot uptime: {} days {}".format(days, hms))
     
 
 
-class RepeatedTimer(object):
+def history_metrics(sample):
     '''
-    Class used to offer periodic "ticks" to users.
-    From StackOverflow user MestreLion (.../users/624066/mestrelion):
-    https://stackoverflow.com/questions/474528/what-is-the-best-way-to-repeatedly-execute-a-function-every-x-seconds-in-python
-    
+    Return the metrics of a history sample as a short line of text.
+    :param sample: a row from HistoryStore.
     '''
-
-    def __init__(self, interval, function, *args, **kwargs):
-        '''
-        Instantiate the timer.
-        :param interval: timer interval (in seconds).
-        :param function: the function to be called every x seconds.
-        :param args: any args to be passed to the functon.
-        :param kwargs: any kwargs to be passed to the functon.
-        '''
-        self._timer     = None
-        self.interval   = interval
-        self.function   = function
-        self.args       = args
-        self.kwargs     = kwargs
-        self.is_running = False
-        self.start()
-
-
-    def _run(self):
-        self.is_running = False
-        self.start()
-        self.function(*self.args, **self.kwargs)
-
-
-    def start(self):
-        if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
-
-
-    def stop(self):
-        self._timer.cancel()
-        self.is_running = False
-
-
+    if sample['loading'] is None:
+        return 'no metrics yet'
+    text = 'loading {:.1%}, usable {:.1%}'.format(sample['loading'], sample['usable'])
+    if sample['key_signal'] is not None:
+        text += ', key signal {:g}'.format(sample['key_signal'])
+    return text
@@ -3,6 +3,8 @@ from getpass import getpass
 from collections import OrderedDict
 from configparser import ConfigParser
 from .instruments.instruments import Instruments
+from .instruments.artifacts import ArtifactCache
+from .history import HistoryStore
 
 DOWNLOADS_MAIN_DIR = 'download'
 
@@ -13,7 +15,8 @@ class BotConfig:
     cfg_text = OrderedDict([
             ('NETWORK', OrderedDict([
                     ('token', 'Register your own copy of this bot with @BotFather, '
-                              'and save your own token below.')])),
+                              'and save your own token below.'),
+                    ('workers', 'Threads handling messages and button presses')])),
             ('COMM', OrderedDict([
                     ('pin', 'Ask for PIN at every X minutes (enter 0 to skip PIN checks):'),
                     ('admins', 'Administrators'),
@@ -25,13 +28,21 @@ class BotConfig:
                     ('kill', '/kill command is received by an admin'),
                     ('tick', '/tick command is received by an admin'),
                     ('untick', '/untick command is received by an admin'),
-                    ('negate', 'Command issued by unauthorized user')]))
+                    ('negate', 'Command issued by unauthorized user')])),
+            ('CACHE', OrderedDict([
+                    ('max_size', 'Maximum size of the downloaded files cache (MB)'),
+                    ('max_days', 'Drop cached files unused for this many days')]))
             ])
     
     # Fields listed under `optionals` can be left blank in the config file.
     # 'pin' can be blank for compatibility with config files previous to v0.1.0.
     # 'users' can be blank because there will always be at least one member in 'admins'.
-    optionals = ['pin', 'users', 'queue', 'blocked']
+    optionals = ['pin', 'users', 'queue', 'blocked', 'max_size', 'max_days', 'workers']
+    # Values given to blank `optionals` (the others are left blank).
+    # 'CACHE' fields and 'workers' are optional for compatibility with config files previous to v0.2.0.
+    defaults = {'max_size': '500',
+                'max_days': '30',
+                'workers': '8'}
     
     # the `instr_cfg_text` holds data for instruments.
     instr_cfg_text = OrderedDict([
@@ -39,7 +50,34 @@ class BotConfig:
             ('type', 'Equipment type (supported: ion)'),
             ('server', 'Equipment address'),
             ('user', 'Username (leave blank for none)'),
-            ('pass', 'Password (leave blank for none, write "ASK" to ask for a password)')])
+            ('pass', 'Password (leave blank for none, write "ASK" to ask for a password)'),
+            ('pool_size', 'Connections kept open to the server'),
+            ('keepalive', 'Reuse connections between requests (yes/no)'),
+            ('retries', 'Retries for failed requests'),
+            ('backoff', 'Backoff factor between retries (seconds)'),
+            ('connect_timeout', 'Seconds to wait for a connection to the server'),
+            ('read_timeout', 'Seconds to wait for the server to answer or send more data'),
+            ('poll_interval', 'Seconds between background polls of the run list (0 to disable)'),
+            ('max_age', 'Maximum age (seconds) of run data before asking the server again'),
+            ('fetch_workers', 'Files downloaded in parallel for a report'),
+            ('fetch_timeout', 'Seconds to wait for a report file before skipping it'),
+            ('statuses', 'Only list runs with these statuses (comma-separated; blank for all)'),
+            ('cache_reports', 'Keep PDF reports in the file cache (yes/no); if no, they are streamed to Telegram')])
+
+    # Instrument fields that may be missing from the config file, with their defaults.
+    instr_optionals = OrderedDict([
+            ('pool_size', '4'),
+            ('keepalive', 'yes'),
+            ('retries', '3'),
+            ('backoff', '0.5'),
+            ('connect_timeout', '10'),
+            ('read_timeout', '60'),
+            ('poll_interval', '60'),
+            ('max_age', '120'),
+            ('fetch_workers', '4'),
+            ('fetch_timeout', '30'),
+            ('statuses', ''),
+            ('cache_reports', 'no')])
     
     def __init__(self, main):
         self.main = main
@@ -58,6 +96,8 @@ class BotConfig:
         config.read("IonWatcher.cfg")
         aborting = False
         for category, items in self.cfg_text.items():
+            if category not in config:
+                config[category] = {}
             for item in items:
                 if item not in config[category] or config[category][item] == '':
                     if item not in self.optionals:
@@ -66,7 +106,7 @@ class BotConfig:
                         aborting = True
                         break
                     else:
-                        config[category][item] = ''
+                        config[category][item] = self.defaults.get(item, '')
             for item in config[category].keys():
                 if item not in self.cfg_text[category].keys():
                     print('Warning: data [{0}] "{1}" not understood.'.format(
@@ -74,6 +114,9 @@ class BotConfig:
         for instr_id in [key for key in config.keys() if key.startswith("INSTRUMENT")]:
             if all(key in config[instr_id] for key in ['name', 'type', 'server', 'user', 'pass']):
                 print("Equipment config found: {} ({})".format(instr_id, config[instr_id]['name']))
+                for key, default in self.instr_optionals.items():
+                    if config[instr_id].get(key, '') == '':
+                        config[instr_id][key] = default
             else:
                 print("ERROR: invalid data for equipment '{}'".format(instr_id))
                 aborting = True
@@ -92,6 +135,12 @@ class BotConfig:
             self.users.update(self.admins)
             self.queue = toset(self.config['COMM']['queue'])
             self.blocked = toset(self.config['COMM']['blocked'])
+            self.artifacts = ArtifactCache(DOWNLOADS_MAIN_DIR,
+                    max_bytes=int(self.config['CACHE']['max_size']) * 1024 * 1024,
+                    max_age=int(self.config['CACHE']['max_days']) * 24 * 60 * 60)
+            if not os.path.exists(DOWNLOADS_MAIN_DIR):
+                os.makedirs(DOWNLOADS_MAIN_DIR)
+            self.history = HistoryStore(os.path.join(DOWNLOADS_MAIN_DIR, 'history.sqlite'))
             self.instr = dict()
             for instr_id in [key for key in config.keys() if key.startswith("INSTRUMENT")]:
                 self.add_server(instr_id)
@@ -148,7 +197,9 @@ class BotConfig:
     def add_server(self, instr_id):
         server = format_server_address(self.config[instr_id]['server'])
         instr_download_dir = "./{}/{}".format(DOWNLOADS_MAIN_DIR, instr_id)
-        handler = Instruments[self.config[instr_id]['type']](server, instr_download_dir, self.main)
+        handler = Instruments[self.config[instr_id]['type']](server, instr_download_dir,
+                                                             self.main, self.config[instr_id],
+                                                             self.artifacts, self.history)
         username = self.config[instr_id]['user']
         flag = 'init'
         while flag != 'ok':
@@ -177,11 +228,13 @@ class BotConfig:
                     opt = opt.strip().upper()
                 if opt == "A":
                     print("Aborting server connection.")
+                    handler.close()
                     return False
                 elif opt == "I":
                     flag = 'ok'
         # Everything OK, adding the server to the instrument list
         self.instr[instr_id] = handler
+        handler.start()
         # Verify that the instrument-specific download directory exists
         if not os.path.exists(instr_download_dir):
             os.makedirs(instr_download_dir)
@@ -59,24 +59,34 @@ class Usercheck(object):
                 logging.warning("couldn't establish user. Update is:" + str(update))
                 return None
             negate_text = instance.cfg.config['MESSAGES']['negate']
-            # Access control
             if username in instance.cfg.blocked:
-                auth = [] # no access
                 negate_text = 'You have been blocked and cannot issue any command.'
-            elif self.userlevel == 'any':
-                auth = True
-            elif self.userlevel == 'user':
-                auth = instance.cfg.users
-            else:
-                auth = instance.cfg.admins
-            if auth is True or username in auth:
+            # Access control
+            if cleared(instance.cfg, username, self.userlevel):
                 logging.info("Approved {0} command from: {1}".format( 
                         logtext, username))
                 return action(sender, bot, update, *args)     
             else:
                 logging.info("Blocked {0} command from: {1}".format( 
                         logtext, username))
-                bot.sendMessage(chat_id=user.id, 
+                instance.outbox.send(bot.sendMessage, chat_id=user.id, 
                         text=negate_text)
                 return None
+        # Lets button routes know which users the action will accept
+        wrapper.userlevel = self.userlevel
         return wrapper
+
+
+def cleared(cfg, username, userlevel):
+    '''
+    Return whether a user may issue commands of a given level.
+    :param cfg: the BotConfig instance.
+    :param str userlevel: 'any', 'user', or 'admin'.
+    '''
+    if username in cfg.blocked:
+        return False
+    elif userlevel == 'any':
+        return True
+    elif userlevel == 'user':
+        return username in cfg.users
+    return username in cfg.admins
@@ -0,0 +1,71 @@
+'''
+Export of the run history to files, written chunk by chunk.
+'''
+
+import csv, gzip, io
+from .history import COLUMNS
+
+## To install pyarrow (needed for Parquet exports only):
+# pip install pyarrow
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('csv', 'parquet')
+
+
+def write_csv(chunks, fileobj):
+    '''
+    Write gzip-compressed CSV, with a header line.
+    :param chunks: an iterable of lists of row tuples, in COLUMNS order.
+    :param fileobj: a binary file open for writing.
+    '''
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as compressed:
+        text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(COLUMNS)
+        for rows in chunks:
+            writer.writerows(rows)
+        text.flush()
+        text.detach()
+
+
+def write_parquet(chunks, fileobj):
+    '''
+    Write a Parquet file with one row group per chunk.
+    :param chunks: an iterable of lists of row tuples, in COLUMNS order.
+    :param fileobj: a binary file open for writing.
+    '''
+    schema = pyarrow.schema([('instrument', pyarrow.string()), ('run_id', pyarrow.int64()),
+                             ('taken', pyarrow.float64()), ('name', pyarrow.string()),
+                             ('status', pyarrow.string()), ('chip', pyarrow.string())] +
+                            [(name, pyarrow.float64()) for name in COLUMNS[6:12]] +
+                            [(name, pyarrow.bool_()) for name in COLUMNS[12:]])
+    with pyarrow.parquet.ParquetWriter(fileobj, schema, compression='snappy') as writer:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            # QC verdicts are stored as 0/1
+            columns[12:] = [[None if value is None else bool(value) for value in verdicts]
+                            for verdicts in columns[12:]]
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(values, type=field.type)
+                 for values, field in zip(columns, schema)], schema=schema))
+
+
+def export(history, instrument, fileobj, fmt='csv', start=None, end=None):
+    '''
+    Write the history samples of an instrument to a file.
+    :param history: a HistoryStore instance.
+    :param instrument: the instrument id.
+    :param fileobj: a binary file open for writing.
+    :param fmt: one of FORMATS.
+    :param start: earliest time included (default: no limit).
+    :param end: time up to which samples are included (default: no limit).
+    '''
+    chunks = history.samples(instrument, start, end)
+    if fmt == 'parquet':
+        write_parquet(chunks, fileobj)
+    else:
+        write_csv(chunks, fileobj)
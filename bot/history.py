@@ -0,0 +1,114 @@
+'''
+Persistent history of run metrics, kept in an SQLite database.
+'''
+
+import sqlite3, threading, time
+
+EXPORT_CHUNK = 5000 # samples read per query by samples()
+
+# Columns taken from RunSummary attributes, in table order
+METRICS = ('name', 'status', 'chip', 'loading', 'live', 'library', 'usable',
+           'key_signal', 'mean_length', 'loading_ok', 'usable_ok', 'key_signal_ok')
+COLUMNS = ('instrument', 'run_id', 'taken') + METRICS
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS samples (
+    instrument TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    taken REAL NOT NULL,
+    name TEXT,
+    status TEXT,
+    chip TEXT,
+    loading REAL,
+    live REAL,
+    library REAL,
+    usable REAL,
+    key_signal REAL,
+    mean_length REAL,
+    loading_ok INTEGER,
+    usable_ok INTEGER,
+    key_signal_ok INTEGER);
+CREATE INDEX IF NOT EXISTS samples_run ON samples (instrument, run_id, taken);
+CREATE INDEX IF NOT EXISTS samples_taken ON samples (instrument, taken);
+'''
+
+
+class HistoryStore:
+    '''
+    Samples of run metrics, appended whenever a run changes on a server, so
+    that runs can be looked back at after they leave the monitor list.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path: the SQLite database file.
+        '''
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+
+
+    def record(self, instrument, runs, taken=None):
+        '''
+        Append one sample per run, in a single transaction.
+        :param instrument: the instrument id, e.g. 'INSTRUMENT_01'.
+        :param runs: an iterable of RunSummary.
+        :param taken: time of the samples (default: now).
+        '''
+        taken = time.time() if taken is None else taken
+        rows = [(instrument, run.id, taken) + tuple(getattr(run, name) for name in METRICS)
+                for run in runs]
+        if not rows:
+            return
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO samples ({}) VALUES ({})'.format(
+                                ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), rows)
+
+
+    def run_history(self, instrument, run_id):
+        '''
+        Return every sample of a run, oldest first.
+        '''
+        with self.lock:
+            return self.db.execute('SELECT * FROM samples WHERE instrument = ? AND run_id = ? '
+                                   'ORDER BY taken', (instrument, run_id)).fetchall()
+
+
+    def last_runs(self, instrument, count):
+        '''
+        Return the latest sample of each of the last `count` runs of an instrument,
+        oldest run first.
+        '''
+        with self.lock:
+            return self.db.execute(
+                    'SELECT samples.* FROM samples JOIN '
+                    '(SELECT run_id, MAX(taken) AS last FROM samples WHERE instrument = ? '
+                    ' GROUP BY run_id ORDER BY run_id DESC LIMIT ?) AS latest '
+                    'ON samples.run_id = latest.run_id AND samples.taken = latest.last '
+                    'WHERE samples.instrument = ? ORDER BY samples.run_id',
+                    (instrument, count, instrument)).fetchall()
+
+
+    def samples(self, instrument, start=None, end=None, chunk=EXPORT_CHUNK):
+        '''
+        Yield the samples of an instrument in lists of at most `chunk` rows,
+        oldest first. The database is only locked while each chunk is read.
+        :param instrument: the instrument id.
+        :param start: earliest time included (default: no limit).
+        :param end: time up to which samples are included (default: no limit).
+        '''
+        start = 0 if start is None else start
+        end = float('inf') if end is None else end
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.db.execute('SELECT rowid, {} FROM samples WHERE instrument = ? '
+                                       'AND taken >= ? AND taken < ? AND rowid > ? '
+                                       'ORDER BY rowid LIMIT ?'.format(', '.join(COLUMNS)),
+                                       (instrument, start, end, last, chunk)).fetchall()
+            if not rows:
+                return
+            last = rows[-1]['rowid']
+            yield [tuple(row)[1:] for row in rows]
@@ -0,0 +1,354 @@
+'''
+asyncio I/O for instrument servers.
+'''
+
+import asyncio, logging, threading, time
+from urllib.parse import urlsplit
+from .connection import CONNECT_TIMEOUT, READ_TIMEOUT
+from .stream import TooLarge, RESUME_ATTEMPTS, UPLOAD_LIMIT
+try:
+    ## To install aiohttp (optional; lets every server request share one event loop):
+    # pip install aiohttp
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+CHUNK_SIZE = 64 * 1024 # bytes
+
+_shared_loop = None
+_shared_lock = threading.Lock()
+
+
+class EventLoop:
+    '''
+    An asyncio event loop running in its own thread.
+    Synchronous code hands coroutines to it with self.run().
+    '''
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='aio',
+                                       daemon=True)
+        self.thread.start()
+
+
+    def run(self, coroutine, timeout=None):
+        '''
+        Run a coroutine on the loop and wait for its result.
+        :param coroutine: the coroutine object to run.
+        :param timeout: seconds to wait, or None to wait indefinitely.
+        '''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+
+def shared_loop():
+    '''
+    Return the event loop shared by all instruments, starting it if needed.
+    '''
+    global _shared_loop
+    with _shared_lock:
+        if _shared_loop is None:
+            _shared_loop = EventLoop()
+        return _shared_loop
+
+
+class AsyncClient:
+    '''
+    Asynchronous GET requests to an instrument server.
+    With aiohttp installed, requests are native coroutines on the shared loop;
+    otherwise the coroutines call the Handler's ConnectionPool directly and never
+    suspend, so they are run in the caller's thread with run_inline().
+    Either way, per-host statistics are kept by the ConnectionPool.
+    '''
+
+    def __init__(self, pool, pool_size=4, retries=3, backoff=0.5,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        '''
+        :param pool: the Handler's ConnectionPool (auth, statistics, fallback transport).
+        :param int pool_size: maximum number of connections kept open per host.
+        :param int retries: how many times a failed request is retried.
+        :param float backoff: backoff factor (in seconds) between retries.
+        :param timeout: (connect, read) timeouts in seconds; the read timeout applies
+                        to each wait for data, so long downloads are not cut short.
+        '''
+        self.pool = pool
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = None # aiohttp.ClientSession, created within the loop
+        self.native = aiohttp is not None
+
+
+    def get_session(self):
+        if self.session is None:
+            auth = self.pool.session.auth
+            self.session = aiohttp.ClientSession(
+                    auth=aiohttp.BasicAuth(auth.username, auth.password),
+                    connector=aiohttp.TCPConnector(limit_per_host=self.pool_size, ssl=False),
+                    timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout[0],
+                                                  sock_read=self.timeout[1]),
+                    trace_configs=[self.trace_config()])
+        return self.session
+
+
+    def trace_config(self):
+        '''
+        Return an aiohttp TraceConfig counting the connections aiohttp opens,
+        so that the ConnectionPool's statistics cover both transports.
+        '''
+        async def request_start(session, context, params):
+            context.host = params.url.host
+
+        async def connection_created(session, context, params):
+            self.pool.opened(context.host)
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(request_start)
+        trace.on_connection_create_end.append(connection_created)
+        return trace
+
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+    async def text(self, url):
+        '''
+        Return the body of a page as text.
+        :param url: the full URL of the page.
+        '''
+        if aiohttp is None:
+            response = self.pool.get(url)
+            return response.text
+        return await self.retrying(url, lambda response: response.text())
+
+
+    async def json(self, url, params=None, headers=None):
+        '''
+        Return a decoded JSON document.
+        :param url: the full URL of the document.
+        :param params: optional query string parameters.
+        :param headers: optional request headers.
+        '''
+        if aiohttp is None:
+            response = self.pool.get(url, params=params, headers=headers)
+            response.raise_for_status()
+            return response.json()
+        return await self.retrying(url, lambda response: response.json(content_type=None),
+                                   params=params, headers=headers)
+
+
+    async def download(self, url, headers, writer, deadline=None, limit=None):
+        '''
+        Stream a file into `writer`, unless the server answers 304 Not Modified.
+        If `headers` ask for a Range and the server sends the whole file instead,
+        writer.restart() is called before writing.
+        :param url: the full URL of the file.
+        :param headers: request headers, e.g. for a conditional GET.
+        :param writer: any object with a `write(bytes)` method.
+        :param deadline: time (as in time.time()) by which the transfer must be
+                         over; raise TimeoutError otherwise (default: no limit).
+        :param limit: size in bytes above which TooLarge is raised, before reading
+                      the body if the server sends a Content-Length (default: no limit).
+        :return: (HTTP status, response headers).
+        '''
+        if aiohttp is None:
+            return self.download_blocking(url, headers, writer, deadline, limit)
+        host = urlsplit(url).hostname
+        start = time.time()
+        kwargs = dict()
+        if deadline is not None:
+            kwargs['timeout'] = self.client_timeout(deadline)
+        try:
+            async with self.get_session().get(url, headers=headers, **kwargs) as response:
+                if response.status != 304:
+                    response.raise_for_status()
+                    if response.status == 200 and 'Range' in headers:
+                        writer.restart()
+                    check_length(response.headers, writer, limit)
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        writer.write(chunk)
+                self.pool.record(host, start)
+                return response.status, response.headers
+        except Exception:
+            self.pool.record(host, start, error=True)
+            raise
+
+
+    def download_blocking(self, url, headers, writer, deadline=None, limit=None):
+        response = self.pool.get(url, headers=headers, stream=True,
+                                 timeout=self.request_timeout(deadline))
+        try:
+            if response.status_code != 304:
+                response.raise_for_status()
+                if response.status_code == 200 and 'Range' in headers:
+                    writer.restart()
+                check_length(response.headers, writer, limit)
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    # requests only limits each read, not the whole transfer
+                    remaining(deadline)
+                    writer.write(chunk)
+        finally:
+            response.close()
+        return response.status_code, response.headers
+
+
+    def client_timeout(self, deadline):
+        '''
+        Return the aiohttp timeout of a request that must be over by `deadline`.
+        '''
+        return aiohttp.ClientTimeout(total=remaining(deadline), sock_connect=self.timeout[0],
+                                     sock_read=self.timeout[1])
+
+
+    def request_timeout(self, deadline):
+        '''
+        Return the (connect, read) timeout of a ConnectionPool request that must
+        be over by `deadline` (None for no deadline).
+        '''
+        left = remaining(deadline)
+        return tuple(limit if left is None else min(limit, left) for limit in self.timeout)
+
+
+    async def size(self, url, deadline=None):
+        '''
+        Ask the server for a file's size without downloading it.
+        :param url: the full URL of the file.
+        :param deadline: time by which the answer is needed (default: no limit).
+        :return: (size in bytes or None if unknown, whether Range requests are accepted).
+        '''
+        if aiohttp is None:
+            response = self.pool.head(url, allow_redirects=True,
+                                      timeout=self.request_timeout(deadline))
+            response.raise_for_status()
+            headers = response.headers
+        else:
+            # A single attempt: this is only a hint, and servers refusing HEAD fail fast
+            headers = await self.retrying(url, headers_of, method='HEAD', retries=0,
+                                          timeout=None if deadline is None else \
+                                                  self.client_timeout(deadline))
+        length = headers.get('Content-Length')
+        return (int(length) if length else None,
+                headers.get('Accept-Ranges', '').lower() == 'bytes')
+
+
+    async def stream(self, url, buffer, limit=UPLOAD_LIMIT, attempts=RESUME_ATTEMPTS,
+                     deadline=None):
+        '''
+        Download a file into a SpooledBuffer, checking its size first: with a HEAD
+        request if the server answers it, else from the GET's Content-Length.
+        Interrupted transfers are resumed where they stopped with Range requests,
+        if the server accepts them, or else started over.
+        :param url: the full URL of the file.
+        :param buffer: a SpooledBuffer (or any writer with `size` and restart()).
+        :param limit: size in bytes above which TooLarge is raised before downloading.
+        :param attempts: how many times an interrupted transfer is resumed.
+        :param deadline: time by which the whole transfer must be over (default: no limit).
+        '''
+        try:
+            size, ranges = await self.size(url, deadline)
+        except Exception as exc:
+            logging.info("No size for {} ({}); checking it on download.".format(url, exc))
+            size, ranges = None, False
+        if size is not None and size > limit:
+            raise TooLarge(size, limit)
+        for attempt in range(attempts + 1):
+            headers = dict()
+            if buffer.size and ranges:
+                headers['Range'] = 'bytes={}-'.format(buffer.size)
+            elif buffer.size:
+                buffer.restart()
+            try:
+                await self.download(url, headers, buffer, deadline, limit)
+                return
+            except TooLarge:
+                raise
+            except Exception as exc:
+                if attempt == attempts or 400 <= status_of(exc) < 500 or \
+                   (deadline is not None and time.time() >= deadline):
+                    raise
+                logging.info("Transfer of {} broke at {} bytes ({}); resuming.".format(
+                             url, buffer.size, exc))
+                await self.sleep(self.backoff * 2 ** attempt)
+
+
+    async def retrying(self, url, read, method='GET', retries=None, **kwargs):
+        '''
+        GET a URL with aiohttp and return read(response), retrying with backoff
+        on connection errors and server errors.
+        :param retries: how many times to retry (default: self.retries).
+        '''
+        host = urlsplit(url).hostname
+        retries = self.retries if retries is None else retries
+        kwargs = {key: value for key, value in kwargs.items() if value is not None}
+        for attempt in range(retries + 1):
+            start = time.time()
+            try:
+                async with self.get_session().request(method, url, **kwargs) as response:
+                    response.raise_for_status()
+                    result = await read(response)
+                self.pool.record(host, start)
+                return result
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                self.pool.record(host, start, error=True)
+                status = getattr(exc, 'status', 500)
+                if attempt == retries or status < 500:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+
+    async def sleep(self, seconds):
+        if self.native:
+            await asyncio.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+
+def remaining(deadline):
+    '''
+    Return the seconds left until `deadline`, or None if there is no deadline;
+    raise TimeoutError once it has passed.
+    '''
+    if deadline is None:
+        return None
+    left = deadline - time.time()
+    if left <= 0:
+        raise TimeoutError("Transfer not over by its deadline.")
+    return left
+
+
+def run_inline(coroutine):
+    '''
+    Run a coroutine that never suspends, such as AsyncClient's without aiohttp,
+    in the calling thread and return its result.
+    '''
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError("Coroutine suspended outside of an event loop.")
+
+
+async def headers_of(response):
+    return response.headers
+
+
+def check_length(headers, writer, limit):
+    '''
+    Raise TooLarge if a response's Content-Length would take `writer` over `limit`.
+    '''
+    length = headers.get('Content-Length')
+    if limit is not None and length and writer.size + int(length) > limit:
+        raise TooLarge(writer.size + int(length), limit)
+
+
+def status_of(exc):
+    '''
+    Return the HTTP status of a failed request (aiohttp or requests), or 0 if none.
+    '''
+    response = getattr(exc, 'response', None)
+    return getattr(exc, 'status', None) or getattr(response, 'status_code', None) or 0
@@ -0,0 +1,273 @@
+'''
+Persistent, content-addressed cache of files downloaded from instrument servers.
+'''
+
+import hashlib, json, logging, os, threading, time
+from tempfile import NamedTemporaryFile
+
+INDEX_SAVE_INTERVAL = 60 # seconds between index writes caused only by cache hits
+
+
+class ArtifactCache:
+    '''
+    Files are stored once under `objects/` by the sha256 of their content, and
+    an index maps (instrument, run id, artifact) to the stored object.
+    Artifacts of completed runs never change and are served straight from disk;
+    the others are revalidated with a conditional GET (ETag/Last-Modified).
+    The least recently used entries are evicted when the cache grows beyond
+    `max_bytes`, and any entry unused for `max_age` seconds is dropped.
+    '''
+    index_name = 'artifacts.json'
+
+    def __init__(self, root, max_bytes, max_age):
+        '''
+        :param root: directory holding the index and the objects.
+        :param int max_bytes: maximum total size of the stored objects.
+        :param int max_age: seconds an entry may go unused before eviction.
+        '''
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, self.index_name)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.index = self.load()
+        self.dirty = False # index changed since last saved
+        self.saved = time.time()
+        self.hits = 0 # served without contacting the server
+        self.revalidated_count = 0 # served after a 304 Not Modified
+        self.downloads = 0 # fully downloaded
+
+
+    @staticmethod
+    def key(instrument, run_id, artifact):
+        return '{}/{}/{}'.format(instrument, run_id, artifact)
+
+
+    def path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+
+    @staticmethod
+    def digest(path):
+        '''
+        Return the content hash of a file returned by self.get().
+        '''
+        return os.path.basename(path)
+
+
+    def lookup(self, instrument, run_id, artifact):
+        '''
+        Check the cache before contacting the server.
+        Return (path, headers): `path` is set if the cached copy can be used as is;
+        otherwise `headers` holds the conditional GET headers to revalidate it
+        (empty if nothing is cached).
+        :param instrument: the instrument id, e.g. 'INSTRUMENT_01'.
+        :param run_id: the run's ID within the server.
+        :param artifact: the artifact name, e.g. 'Bead_density_200.png'.
+        '''
+        key = self.key(instrument, run_id, artifact)
+        headers = dict()
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None and not os.path.isfile(self.path(entry['hash'])):
+                self.index.pop(key)
+                self.dirty = True
+                entry = None
+            if entry is None:
+                return None, headers
+            if entry['immutable']:
+                self.hits += 1
+                self.touch(entry)
+                return self.path(entry['hash']), headers
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return None, headers
+
+
+    def revalidated(self, instrument, run_id, artifact, immutable=False):
+        '''
+        Record that the server answered 304 Not Modified; return the cached path
+        (or None if the entry was evicted meanwhile).
+        :param bool immutable: True if the artifact can no longer change (completed run).
+        '''
+        with self.lock:
+            entry = self.index.get(self.key(instrument, run_id, artifact))
+            if entry is None:
+                return None
+            self.revalidated_count += 1
+            entry['immutable'] = immutable
+            self.touch(entry)
+            return self.path(entry['hash'])
+
+
+    def writer(self):
+        '''
+        Return an ObjectWriter for a new download; pass it to self.commit() when done.
+        '''
+        os.makedirs(self.objects, exist_ok=True)
+        return ObjectWriter(self.objects)
+
+
+    def commit(self, instrument, run_id, artifact, writer, headers, immutable=False):
+        '''
+        Move a completed download into the store and index it; return its path.
+        :param writer: the ObjectWriter holding the download.
+        :param headers: the response headers (for ETag and Last-Modified).
+        :param bool immutable: True if the artifact can no longer change (completed run).
+        '''
+        digest, size = writer.close()
+        with self.lock:
+            dest = self.path(digest)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            # Identical content may already be stored for another run
+            os.replace(writer.name, dest)
+            self.downloads += 1
+            self.index[self.key(instrument, run_id, artifact)] = {
+                    'hash': digest,
+                    'size': size,
+                    'etag': headers.get('ETag'),
+                    'last_modified': headers.get('Last-Modified'),
+                    'immutable': immutable,
+                    'used': time.time()}
+            self.evict()
+            self.save()
+        return dest
+
+
+    def touch(self, entry):
+        '''
+        Mark an entry as used. The index is written at most every
+        INDEX_SAVE_INTERVAL seconds for this, not on every hit.
+        '''
+        entry['used'] = time.time()
+        self.dirty = True
+        if entry['used'] - self.saved > INDEX_SAVE_INTERVAL:
+            self.save()
+
+
+    def evict(self):
+        '''
+        Drop entries unused for longer than `max_age`, then the least recently
+        used ones until the objects fit within `max_bytes`, and delete the
+        objects they leave unreferenced.
+        '''
+        with self.lock:
+            dropped = set()
+            oldest = time.time() - self.max_age
+            for key in [key for key, entry in self.index.items() if entry['used'] < oldest]:
+                dropped.add(self.index.pop(key)['hash'])
+            sizes = {entry['hash']: entry['size'] for entry in self.index.values()}
+            total = sum(sizes.values())
+            for key, entry in sorted(self.index.items(), key=lambda item: item[1]['used']):
+                if total <= self.max_bytes:
+                    break
+                self.index.pop(key)
+                dropped.add(entry['hash'])
+                if all(other['hash'] != entry['hash'] for other in self.index.values()):
+                    total -= sizes[entry['hash']]
+            if dropped:
+                self.dirty = True
+            referenced = set(entry['hash'] for entry in self.index.values())
+            for digest in dropped - referenced:
+                if os.path.isfile(self.path(digest)):
+                    os.remove(self.path(digest))
+
+
+    def expire(self):
+        '''
+        Evict, remove orphaned objects and save the index; scheduled, so that
+        entries age out even when nothing new is downloaded.
+        '''
+        with self.lock:
+            self.evict()
+            self.remove_orphans()
+            self.flush()
+
+
+    def flush(self):
+        '''
+        Save the index if it changed since it was last saved.
+        '''
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+
+    def remove_orphans(self):
+        '''
+        Delete stored objects that no index entry refers to, e.g. left behind
+        when the bot stopped before saving the index.
+        '''
+        if not os.path.isdir(self.objects):
+            return
+        referenced = set(entry['hash'] for entry in self.index.values())
+        for subdir in os.listdir(self.objects):
+            subpath = os.path.join(self.objects, subdir)
+            if not os.path.isdir(subpath):
+                continue
+            for digest in os.listdir(subpath):
+                if digest not in referenced:
+                    os.remove(os.path.join(subpath, digest))
+
+
+    def load(self):
+        if not os.path.isfile(self.index_path):
+            return dict()
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except ValueError:
+            logging.warning("Artifact cache index is corrupt; starting afresh.")
+            return dict()
+
+
+    def save(self):
+        with self.lock:
+            with NamedTemporaryFile('w', dir=self.root, delete=False) as index_file:
+                json.dump(self.index, index_file)
+            os.replace(index_file.name, self.index_path)
+            self.dirty = False
+            self.saved = time.time()
+
+
+    def stats(self):
+        with self.lock:
+            sizes = {entry['hash']: entry['size'] for entry in self.index.values()}
+            return {'entries': len(self.index), 'bytes': sum(sizes.values()),
+                    'hits': self.hits, 'revalidated': self.revalidated_count,
+                    'downloads': self.downloads}
+
+
+class ObjectWriter:
+    '''
+    A temporary file within the object store that hashes what is written to it.
+    '''
+
+    def __init__(self, directory):
+        self.file = NamedTemporaryFile(dir=directory, delete=False)
+        self.name = self.file.name
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+
+    def write(self, chunk):
+        self.sha.update(chunk)
+        self.size += len(chunk)
+        self.file.write(chunk)
+
+
+    def close(self):
+        '''
+        Close the file and return (sha256, size).
+        '''
+        self.file.close()
+        return self.sha.hexdigest(), self.size
+
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.name):
+            os.remove(self.name)
@@ -0,0 +1,44 @@
+'''
+Detection of changes between successive snapshots of runs.
+'''
+
+
+def diff_runs(old, new):
+    '''
+    Compare two {run id: RunSummary} dictionaries and describe what changed.
+    :param old: the runs in the previous snapshot.
+    :param new: the runs in the current snapshot.
+    :return: a list of (run id, description) tuples, ordered by run id.
+    '''
+    events = []
+    for run_id in sorted(set(old) | set(new)):
+        before = old.get(run_id)
+        after = new.get(run_id)
+        if before is None:
+            events.append((run_id, '[{}] {}: new run ({})'.format(
+                           run_id, after.name, after.status)))
+        elif after is None:
+            events.append((run_id, '[{}] {}: no longer monitored'.format(
+                           run_id, before.name)))
+        else:
+            changes = []
+            if before.status != after.status:
+                changes.append('{} -> {}'.format(before.status, after.status))
+            for fields, description in ((('loading', 'live', 'library', 'usable'),
+                                         'analysis metrics'),
+                                        (('key_signal', 'mean_length'),
+                                         'library metrics')):
+                previous = tuple(getattr(before, field) for field in fields)
+                current = tuple(getattr(after, field) for field in fields)
+                if previous == current:
+                    continue
+                elif previous[0] is None:
+                    changes.append(description + ' available')
+                elif current[0] is None:
+                    changes.append(description + ' removed')
+                else:
+                    changes.append(description + ' updated')
+            if changes:
+                events.append((run_id, '[{}] {}: {}'.format(
+                               run_id, after.name, ', '.join(changes))))
+    return events
@@ -0,0 +1,122 @@
+'''
+Pooled HTTP connections to instrument servers.
+'''
+
+import threading, time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CONNECT_TIMEOUT = 10 # seconds to wait for a connection to a server
+READ_TIMEOUT = 60 # seconds to wait for a server to send anything
+
+
+class ConnectionPool:
+    '''
+    A keep-alive HTTP session owned by one instrument Handler.
+    Connections (and their TLS handshakes) are reused across calls, failed
+    requests are retried with exponential backoff and per-host statistics are
+    kept so admins can see how the pool is doing.
+    '''
+
+    def __init__(self, auth, pool_size=4, keepalive=True, retries=3, backoff=0.5,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        '''
+        :param auth: a requests.auth object, sent with every request.
+        :param int pool_size: maximum number of connections kept open per host.
+        :param bool keepalive: if False, close connections after each request.
+        :param int retries: how many times a failed request is retried.
+        :param float backoff: backoff factor (in seconds) between retries.
+        :param timeout: (connect, read) timeouts in seconds, used unless a request sets its own.
+        '''
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.verify = False
+        if not keepalive:
+            self.session.headers['Connection'] = 'close'
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(500, 502, 503, 504))
+        self.adapter = HTTPAdapter(pool_connections=pool_size,
+                                   pool_maxsize=pool_size,
+                                   max_retries=retry)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.lock = threading.Lock()
+        self.hosts = dict() # {hostname: {'requests': n, 'errors': n, 'seconds': s}}
+
+
+    def get(self, url, **kwargs):
+        '''
+        Issue a GET request through the pool.
+        :param url: the full URL to be requested.
+        :param kwargs: any kwargs accepted by requests.Session.get.
+        '''
+        return self.request('GET', url, **kwargs)
+
+
+    def head(self, url, **kwargs):
+        '''
+        Issue a HEAD request through the pool.
+        :param url: the full URL to be requested.
+        :param kwargs: any kwargs accepted by requests.Session.head.
+        '''
+        return self.request('HEAD', url, **kwargs)
+
+
+    def request(self, method, url, **kwargs):
+        host = urlsplit(url).hostname
+        # A server that hangs must not hold the caller (and everyone waiting on it) forever
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.record(host, start, error=True)
+            raise
+        self.record(host, start)
+        return response
+
+
+    def record(self, host, start, error=False):
+        with self.lock:
+            counters = self.hosts.setdefault(host, {'requests': 0, 'errors': 0,
+                                                    'seconds': 0.0})
+            counters['requests'] += 1
+            counters['errors'] += int(error)
+            counters['seconds'] += time.time() - start
+
+
+    def opened(self, host):
+        '''
+        Count a connection opened to `host` by another transport (e.g. aiohttp).
+        '''
+        with self.lock:
+            counters = self.hosts.setdefault(host, {'requests': 0, 'errors': 0,
+                                                    'seconds': 0.0})
+            counters['connections'] = counters.get('connections', 0) + 1
+
+
+    def stats(self):
+        '''
+        Return per-host statistics as {hostname: {counter: value}}.
+        'connections' is the number of connections actually opened (by requests,
+        or by aiohttp through self.opened()), so a value much lower than
+        'requests' means keep-alive is doing its job.
+        '''
+        with self.lock:
+            out = {host: dict(counters) for host, counters in self.hosts.items()}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            counters = out.setdefault(pool.host, {'requests': 0, 'errors': 0,
+                                                  'seconds': 0.0})
+            counters['connections'] = counters.get('connections', 0) + pool.num_connections
+        return out
+
+
+    def close(self):
+        self.session.close()
@@ -1,7 +1,7 @@
 from telegram import error
-import json, logging, re
-from shutil import copyfileobj
+import functools, hashlib, json, logging, os, re, threading, time
 from collections import OrderedDict
+from concurrent import futures
 import requests
 ## To install bs4:
 # pip install beautifulsoup4
@@ -11,25 +11,85 @@ import requests
 # sudo apt install python-lxml
 from bs4 import BeautifulSoup
 from ..decorators import Usercheck
+from ..jobs import Job, Cancelled
+from ..outbox import NOTIFICATION, split_messages, join_messages
+from .connection import ConnectionPool
+from .aio import AsyncClient, run_inline, shared_loop
+from .snapshot import MonitorPoller
+from .singleflight import SingleFlight
+from .changes import diff_runs
+from .runs import RunSummary
+from .stream import SpooledBuffer, TooLarge
+
+REPORT_CACHE_SIZE = 256 # rendered run reports kept in memory, per instrument
+NON_WORD = re.compile(r'\W+') # used by collapse()
 
 class Handler:
     # Specify the authorization mode to contact the server (see config.py)
     authmode = 'http_pw'
     
     api = 'rundb/api/v1/'
+    # Fields read for the run list. The large `experiment` object (with the QC
+    # thresholds) is only read for reports, one run at a time.
+    list_fields = ['id', 'resultsName', 'status', 'timeStamp',
+                   'analysismetrics', 'libmetrics']
+    page_size = 20 # runs per request to the API
+    report_loc = 'report/latex/{}.pdf' # PDF report of a run, relative to the server
     
-    def __init__(self, server, download_loc, mainloop):
+    def __init__(self, server, download_loc, mainloop, settings, artifacts, history):
         self.methods = OrderedDict([('Check runs in progress', self.monitor)])
         self.server = server
         self.download_loc = download_loc
         self.mainloop = mainloop
+        self.settings = settings # the [INSTRUMENT_xx] config section
+        self.instr_id = settings.name
+        self.flights = SingleFlight()
+        self.artifacts = artifacts # ArtifactCache shared by all instruments
+        self.history = history # HistoryStore shared by all instruments
+        self.fetcher = futures.ThreadPoolExecutor(max_workers=settings.getint('fetch_workers'))
+        self.fetch_timeout = settings.getint('fetch_timeout')
+        self.cache_reports = settings.getboolean('cache_reports')
+        self.rendered = (None, []) # (snapshot version, rendered monitor messages)
+        self.reports = OrderedDict() # {(instrument, RunSummary): report text}
+        self.reports_lock = threading.Lock()
+        self.report_hits = 0
+        self.report_misses = 0
+        self.progress_lock = threading.Lock() # guards Job.stage_text, see report_progress()
+        self.live = dict() # {chat_id: [bot, message_id, text digest]} for live status messages
+        self.live_lock = threading.Lock()
+        # {chat_id: None for the whole instrument, or a set of run IDs}
+        self.subscriptions_file = os.path.join(download_loc, 'subscriptions.json')
+        self.subscriptions = self.load_subscriptions()
+        self.subscriptions_lock = threading.Lock()
+        self.http = None # ConnectionPool, set up by init_connection
+        self.aio = None # AsyncClient, set up by init_connection
+        self.loop = None # EventLoop shared by all instruments, if aiohttp is installed
+        self.poller = MonitorPoller(self.read_monitor,
+                                    interval=settings.getint('poll_interval'),
+                                    name=self.instr_id)
+        self.poller.listeners.append(self.update_live)
+        self.poller.listeners.append(self.notify_changes)
+        self.poller.listeners.append(self.record_history)
+        self.max_age = settings.getint('max_age')
+        self.statuses = [status.strip() for status in settings['statuses'].split(',')
+                         if status.strip()]
+        self.details = dict() # {run_id: RunSummary}, full data of completed runs
+        self.experiments = dict() # {run_id: chip type and QC thresholds}, of runs read once
         self.init_specifics()
         # ("Button name", <method>, "callback_data")
-        self.keyboard = [("Monitor runs", self.monitor, "Monitor")]
+        self.keyboard = (("Monitor runs", self.monitor, "Monitor"),
+                         ("Live status", self.live_status, "Live"),
+                         ("Notifications on/off", self.toggle_notifications, "Notify"))
+        # ("callback_data prefix", <method>) for buttons whose callback_data ends with an ID
+        self.families = (("Run_", self.run_report),)
+        # Run buttons are built once per snapshot and shared by all chats; each chat
+        # keeps the ones it was last shown, so one user's click never changes another's.
+        self.run_buttons = (None, ()) # (snapshot version, run buttons)
+        self.views = dict() # {chat_id: (snapshot version, run buttons) last shown to the chat}
+        self.views_lock = threading.Lock()
         
 
     def init_specifics(self):
-        self.runs = dict()
         # File location and description of downloadable images on the server    
         self.images = [['Bead_density_200.png', 'bead density'],
                        ['basecaller_results/wells_beadogram.png', 'bead quality data'],
@@ -38,33 +98,98 @@ class Handler:
 
     
     def init_connection(self, username, pw):
+        '''
+        Set up the connections to the server and test them.
+        Background polling only starts with self.start(), once the server is added.
+        :return: the flag of a first read of the runs ('ok' if it worked).
+        '''
         self.auth = requests.auth.HTTPBasicAuth(username, pw)
-        runs, flag = self.read_monitor()
-        return flag
+        # A retry replaces the connections of the previous attempt
+        self.close()
+        timeout = (self.settings.getfloat('connect_timeout'),
+                   self.settings.getfloat('read_timeout'))
+        self.http = ConnectionPool(self.auth,
+                                   pool_size=self.settings.getint('pool_size'),
+                                   keepalive=self.settings.getboolean('keepalive'),
+                                   retries=self.settings.getint('retries'),
+                                   backoff=self.settings.getfloat('backoff'),
+                                   timeout=timeout)
+        self.aio = AsyncClient(self.http,
+                               pool_size=self.settings.getint('pool_size'),
+                               retries=self.settings.getint('retries'),
+                               backoff=self.settings.getfloat('backoff'),
+                               timeout=timeout)
+        self.loop = shared_loop() if self.aio.native else None
+        return self.read_monitor()[1]
+
+
+    def start(self):
+        self.poller.start()
+
+
+    def close(self):
+        '''
+        Stop polling and release the connections to the server.
+        '''
+        self.poller.stop()
+        if self.aio is not None:
+            self.run(self.aio.close)
+            self.aio = None
+        if self.http is not None:
+            self.http.close()
+            self.http = None
+
+
+    def stats(self):
+        '''
+        Return a list of text lines describing this instrument's connections.
+        '''
+        lines = []
+        if self.http is None:
+            return lines
+        for host, counters in sorted(self.http.stats().items()):
+            mean = counters['seconds'] / max(counters['requests'], 1)
+            lines.append('{}: {} requests over {} connections, {} errors, '
+                         '{:.2f}s mean'.format(host, counters['requests'],
+                                               counters.get('connections', 0),
+                                               counters['errors'], mean))
+        flights = self.flights.stats()
+        lines.append('Coalesced fetches: {} upstream, {} saved'.format(
+                     flights['upstream'], flights['saved']))
+        lines.append('Rendered reports: {} cached, {} hits, {} misses'.format(
+                     len(self.reports), self.report_hits, self.report_misses))
+        return lines
 
 
-    def report_link(self, bot, update, run):
+    def report_link(self, bot, update, run, report=None, deadline=None):
         '''
         Attempt to deliver a run's PDF report.
         :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
         :param update: the received update, automatically informed by python-telegram-bot.
-        :param run: serialized run data read from the server by self.read_monitor().
+        :param run: the RunSummary read from the server by self.read_run().
+        :param report: optional future for the PDF, as started by self.fetch_artifacts().
+        :param deadline: time after which `report` is given up on.
         '''
         user = update.effective_user
-        run_dir_id = run['id']
-        if run['status'] == 'Completed':
-            report_pdf = self.get_pdf(run_dir_id)
+        run_dir_id = run.id
+        if run.completed and not self.cache_reports:
+            self.send_streamed_pdf(bot, user.id, run_dir_id, report)
+        elif run.completed:
+            if report is None:
+                report_pdf = self.get_pdf(run_dir_id)
+            else:
+                report_pdf = wait_for(report, deadline)
             if report_pdf:
-                self.pdf(bot, update, run_dir_id)
+                self.pdf(bot, update, run_dir_id, report_pdf)
             else:
-                bot.sendMessage(chat_id=user.id, text=\
+                self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text=\
                                 "Run is complete, but I couldn't retrieve the pdf report.")
         else:
-            bot.sendMessage(chat_id=user.id, text="The pdf report is not ready yet.")
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text="The pdf report is not ready yet.")
 
     
     # EACH INSTRUMENT-SPECIFIC METHOD MUST:
-    # 1. BE LISTED IN self.keyboard
+    # 1. BE LISTED IN self.keyboard (OR self.families)
     # 2. ACCEPT PARAMETERS (self, bot, update, callback_data)
     # 3. RETURN THE NEXT STATUS FOR THE CHAT
     # 4. NOT CALL THE KEYBOARD AGAIN
@@ -78,64 +203,298 @@ class Handler:
         :param update: the received update, automatically informed by python-telegram-bot.
         '''
         user = update.effective_user
-        runs, flag = self.read_monitor()
+        snapshot = self.poller.get(self.max_age)
+        runs, flag = snapshot.runs, snapshot.flag
+        with self.views_lock:
+            _version, shown = self.views.get(user.id, (None, ()))
+        # Notes are sent together with the list of runs, in as few messages as possible
+        notes = []
         
         if flag == 'no_connection':
-            bot.sendMessage(chat_id=user.id,
-                            text="I'm sorry {}, I couldn't connect to the server.".format(
-                            user.first_name))
+            notes.append("I'm sorry {}, I couldn't connect to the server.".format(
+                         user.first_name))
+            if runs:
+                notes.append("These are the last runs I know of, from {} ago:".format(
+                             snapshot.age_text()))
         
         elif flag == 'no_data':
-            bot.sendMessage(chat_id=user.id,
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id,
                             text="I'm sorry {}, I couldn't retrieve any data.".format(
                             user.first_name))
-            self.chats[user.id]['status'] = 'start'
-            self.keyboard(bot, update)
-            return
+            return 'start'
         elif flag == 'multiple':
-            bot.sendMessage(chat_id=user.id, 
-                            text="{}, I found multiple data, which was unexpected."
-                            "However, I hope this is the list of runs.".format(
-                            user.first_name))
+            notes.append("{}, I found multiple data, which was unexpected."
+                         "However, I hope this is the list of runs.".format(
+                         user.first_name))
         elif flag == 'ok':
-            bot.sendMessage(chat_id=user.id, 
-                            text="I have found {0} runs:".format(
-                            len(runs)))
-            if (not runs) and self.runs:
-                bot.sendMessage(chat_id=user.id, 
-                        text="However, I have {0} runs in menory:".format(
-                        len(self.runs)))
+            notes.append("I have found {0} runs (data from {1} ago):".format(
+                         len(runs), snapshot.age_text()))
+            if (not runs) and shown:
+                notes.append("However, I have {0} runs in menory:".format(
+                             len(shown)))
         else:
-            bot.sendMessage(chat_id=user.id, 
-                            text="I'm sorry, something went unexpectedly wrong.")
+            notes.append("I'm sorry, something went unexpectedly wrong.")
 
         if runs:
-            # self.runs.update(runs)
-            self.runs = runs
-            # Clean the keyboard
-            torem = [item for item in self.keyboard if item[2].startswith('Run_')]
-            for item in torem:
-                self.keyboard.remove(item)
-            for run_dir_id, run in sorted(self.runs.items()):
-                # TODO see flows
-                runname = re.sub('Auto_[\w]*?_', '', run['resultsName'])
-                run_status = run['status']
-                string = ('[{}]\n{}\n'        
-                          'Status: {}'.format(run_dir_id, runname,         
-                                              run_status))
-                bot.sendMessage(chat_id=user.id, text=string)
-            for run in self.runs:
-                self.keyboard.append(["View run " + str(run).rjust(4, ' '), \
-                                      self.run_report, 'Run_'+str(run)])
+            view = self.snapshot_buttons(snapshot)
+            with self.views_lock:
+                self.views[user.id] = view
+            messages = self.render_monitor(snapshot)
+        else:
+            messages = []
+        for text in join_messages(notes, messages):
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text=text)
         return 'instr'
         
-        
+
+    def snapshot_buttons(self, snapshot):
+        '''
+        Return (snapshot version, run buttons) for a snapshot, building the
+        buttons once per snapshot version.
+        :param snapshot: a Snapshot from self.poller.
+        '''
+        view = self.run_buttons
+        if view[0] != snapshot.version:
+            buttons = tuple(("View run " + str(run).rjust(4, ' '), self.run_report,
+                             'Run_'+str(run)) for run in snapshot.runs)
+            # A single assignment, so readers always see a matching pair
+            view = self.run_buttons = (snapshot.version, buttons)
+        return view
+
+
+    def view(self, chat_id):
+        '''
+        Return (version, buttons) of this instrument's keyboard for a chat. Buttons are
+        an immutable tuple of ("Button name", <method>, "callback_data"): self.keyboard,
+        followed by the runs the chat was last shown by self.monitor(). Chats with
+        the same version have the same buttons.
+        :param chat_id: the user's chat.
+        '''
+        with self.views_lock:
+            version, buttons = self.views.get(chat_id, (None, ()))
+        return version, self.keyboard + buttons
+
+
+    @Usercheck('user')
+    def live_status(self, bot, update, callback_data):
+        '''
+        Start or stop a single status message that is edited whenever the runs change.
+        :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
+        :param update: the received update, automatically informed by python-telegram-bot.
+        '''
+        user = update.effective_user
+        with self.live_lock:
+            watching = self.live.pop(user.id, None)
+        if watching is not None:
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id,
+                                      text="Live status stopped.")
+            return 'instr'
+        text = self.live_text(self.poller.get(self.max_age))
+        message = self.mainloop.outbox.call(bot.sendMessage, chat_id=user.id, text=text)
+        with self.live_lock:
+            self.live[user.id] = [bot, message.message_id, digest(text)]
+        return 'instr'
+
+
+    def overview(self):
+        '''
+        Return a short summary of this instrument's runs, for the all-instruments overview.
+        '''
+        snapshot = self.poller.get(self.max_age)
+        name = self.settings['name']
+        if snapshot.flag != 'ok' and not snapshot.taken:
+            return '{}: unreachable'.format(name)
+        statuses = OrderedDict()
+        for _run_id, run in sorted(snapshot.runs.items()):
+            statuses[run.status] = statuses.get(run.status, 0) + 1
+        text = '{}: {} runs{}'.format(name, len(snapshot.runs),
+               ''.join('\n  {} {}'.format(count, status) for status, count in statuses.items()))
+        if snapshot.flag != 'ok':
+            return text + '\n  (unreachable; data from {} ago)'.format(snapshot.age_text())
+        return text + '\n  (data from {} ago)'.format(snapshot.age_text())
+
+
+    def live_text(self, snapshot):
+        '''
+        Return the text of a live status message for a snapshot.
+        '''
+        header = 'Live status: {} (last change at {})'.format(
+                 self.settings['name'], time.strftime('%H:%M', time.localtime(snapshot.changed)))
+        # Only one message can be kept updated
+        return join_messages([header], self.render_monitor(snapshot))[0]
+
+
+    def update_live(self, old, new):
+        '''
+        Edit the live status messages after the runs changed; called by self.poller.
+        :param old: the previous Snapshot (or None).
+        :param new: the new Snapshot.
+        '''
+        text = self.live_text(new)
+        text_digest = digest(text)
+        with self.live_lock:
+            targets = []
+            for chat_id, entry in self.live.items():
+                if entry[2] != text_digest:
+                    entry[2] = text_digest
+                    targets.append((chat_id, entry[0], entry[1]))
+        for chat_id, bot, message_id in targets:
+            future = self.mainloop.outbox.send(bot.editMessageText, priority=NOTIFICATION,
+                                               chat_id=chat_id, message_id=message_id,
+                                               text=text)
+            future.add_done_callback(lambda future, chat_id=chat_id:
+                                     self.live_failed(chat_id, future))
+
+
+    def live_failed(self, chat_id, future):
+        '''
+        Stop updating a live status message that can no longer be edited.
+        '''
+        exc = future.exception()
+        if isinstance(exc, error.BadRequest) and 'not modified' not in str(exc).lower():
+            with self.live_lock:
+                self.live.pop(chat_id, None)
+
+
+    @Usercheck('user')
+    def toggle_notifications(self, bot, update, callback_data):
+        '''
+        Subscribe to (or unsubscribe from) changes of any run on this instrument.
+        :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
+        :param update: the received update, automatically informed by python-telegram-bot.
+        '''
+        user = update.effective_user
+        if user.id in self.subscriptions:
+            text = self.unsubscribe(user.id)
+        else:
+            text = self.subscribe(user.id)
+        self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text=text)
+        return 'instr'
+
+
+    def subscribe(self, chat_id, run_id=None):
+        '''
+        Send the chat notifications when runs change.
+        :param chat_id: the subscribing chat.
+        :param run_id: a single run to watch; if None, watch the whole instrument.
+        :return: a message for the user.
+        '''
+        with self.subscriptions_lock:
+            if run_id is None:
+                self.subscriptions[chat_id] = None
+                text = "You will be notified of changes to any run on {}.".format(
+                       self.settings['name'])
+            elif self.subscriptions.get(chat_id, set()) is None:
+                text = "You are already notified of every run on {}.".format(
+                       self.settings['name'])
+            else:
+                self.subscriptions.setdefault(chat_id, set()).add(run_id)
+                text = "You will be notified of changes to run {}.".format(run_id)
+            self.save_subscriptions()
+        return text
+
+
+    def unsubscribe(self, chat_id, run_id=None):
+        '''
+        Stop notifications for a run, or for the whole instrument if run_id is None.
+        :return: a message for the user.
+        '''
+        with self.subscriptions_lock:
+            runs = self.subscriptions.get(chat_id, set())
+            if run_id is None or runs is None or runs == {run_id}:
+                self.subscriptions.pop(chat_id, None)
+                text = "You will no longer be notified of changes on {}.".format(
+                       self.settings['name'])
+            else:
+                runs.discard(run_id)
+                text = "You will no longer be notified of changes to run {}.".format(run_id)
+            self.save_subscriptions()
+        return text
+
+
+    def notify_changes(self, old, new):
+        '''
+        Send subscribers what changed between two snapshots; called by self.poller.
+        One upstream poll serves every subscriber.
+        :param old: the previous Snapshot (or None).
+        :param new: the new Snapshot.
+        '''
+        if old is None or not old.runs:
+            # Nothing to compare with (first poll, or the server was unreachable)
+            return
+        with self.subscriptions_lock:
+            subscriptions = list(self.subscriptions.items())
+        events = diff_runs(old.runs, new.runs)
+        if not events or not subscriptions:
+            return
+        bot = self.mainloop.updater.bot
+        header = 'Changes on {}:'.format(self.settings['name'])
+        for chat_id, runs in subscriptions:
+            lines = [text for run_id, text in events if runs is None or run_id in runs]
+            if not lines:
+                continue
+            for text in join_messages([header], split_messages(lines, separator='\n')):
+                self.mainloop.outbox.send(bot.sendMessage, priority=NOTIFICATION,
+                                          chat_id=chat_id, text=text)
+
+
+    def record_history(self, old, new):
+        '''
+        Store a sample of every run that changed; called by self.poller.
+        The run list has no chip type or QC thresholds, so the details of a
+        run are read once when it is first seen completed; later snapshots
+        carry them over (see with_experiment).
+        :param old: the previous Snapshot (or None).
+        :param new: the new Snapshot.
+        '''
+        changed = []
+        for run_id, run in sorted(new.runs.items()):
+            if (run.completed and run_id not in self.experiments
+                    and self.read_run(run_id) is not None):
+                continue # read_run stored a sample with the full data
+            if old is None or old.runs.get(run_id) != run:
+                changed.append(run)
+        self.history.record(self.instr_id, changed, new.taken)
+
+
+    def load_subscriptions(self):
+        if not os.path.isfile(self.subscriptions_file):
+            return dict()
+        with open(self.subscriptions_file) as subs_file:
+            stored = json.load(subs_file)
+        return {int(chat_id): None if runs is None else set(runs)
+                for chat_id, runs in stored.items()}
+
+
+    def save_subscriptions(self):
+        stored = {chat_id: None if runs is None else sorted(runs)
+                  for chat_id, runs in self.subscriptions.items()}
+        with open(self.subscriptions_file, 'w') as subs_file:
+            json.dump(stored, subs_file)
+
+
+    def render_monitor(self, snapshot):
+        '''
+        Return the list of runs in a snapshot as message texts.
+        The rendering is kept for as long as the snapshot version does not change.
+        :param snapshot: a Snapshot from self.poller.
+        '''
+        version, messages = self.rendered
+        if version != snapshot.version:
+            blocks = []
+            for run_dir_id, run in sorted(snapshot.runs.items()):
+                # TODO see flows
+                blocks.append('[{}]\n{}\n'
+                              'Status: {}'.format(run_dir_id, run.name, run.status))
+            messages = split_messages(blocks)
+            self.rendered = (snapshot.version, messages)
+        return messages
 
 
     @Usercheck('user')
     def run_report(self, bot, update, callback_data):
         '''
-        Message run report data to the user.
+        Queue a run report for the user; it is sent by a background job.
         :param bot: telegram.bot.Bot instance, automatically informed by python-telegram-bot.
         :param update: the received update, automatically informed by python-telegram-bot.
         :param callback_data: the callback_data string, that contains the run ID.
@@ -143,96 +502,300 @@ class Handler:
         user = update.effective_user
         # runs         
         run_id = int(callback_data[4:])
-        run = self.runs.get(run_id, None)
+        job = Job(user.id, 'run {} on {}'.format(run_id, self.settings['name']),
+                  progress=functools.partial(self.report_progress, bot))
+        # Acknowledge first, so that the job can show its progress from the very start
+        job.message = self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id,
+                            text="Preparing the report of run {}...".format(run_id))
+        queued = self.mainloop.jobs.submit(job, self.report_job, bot, update, run_id)
+        if queued is None:
+            self.report_progress(bot, job, "I'm preparing too many reports right now; "
+                                           "please try again in a minute.")
+        elif queued is not job:
+            self.report_progress(bot, job, "already on its way.")
+        return 'instr'
+
+
+    def report_job(self, job, bot, update, run_id):
+        '''
+        Read a run and message its report to the user; runs as a background Job.
+        :param job: the Job, used to report progress (and to stop if cancelled).
+        :param run_id: the run's ID within the server.
+        '''
+        user = update.effective_user
+        run = self.read_run(run_id)
+        if run is None:
+            self.report_progress(bot, job, "failed.")
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id,
+                            text="I couldn't retrieve run {} from the server.".format(run_id))
+            return
         try:
-            self.execute_report(bot, update, run)
+            job.stage("run data read.")
+            self.execute_report(bot, update, run, job)
+        except Cancelled:
+            self.report_progress(bot, job, "cancelled by a newer request.")
+            raise
         except error.TimedOut:
-            bot.sendMessage(chat_id=user.id, text="Sorry, I lost connection to Telegram while fulfilling your request.")
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text="Sorry, I lost connection to Telegram while fulfilling your request.")
             logging.warning("Lost connection to Telegram.")
-            self.chats[user.id].set_status('start')
+        except Exception:
+            self.report_progress(bot, job, "failed.")
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id,
+                            text="Sorry, something went wrong while preparing the report of "
+                                 "run {}.".format(run_id))
+            # Still counted (and logged) as a failed job
+            raise
+
+
+    def report_progress(self, bot, job, text):
+        '''
+        Show the stage a report job is at, by editing the message that acknowledged it.
+        Edits come after the report's own messages and only show the latest stage,
+        so they take as little as possible of the chat's rate limit from the report.
+        '''
+        if job.message is None:
+            return
+        with self.progress_lock:
+            queued = job.stage_text is not None
+            job.stage_text = text
+        if not queued:
+            self.mainloop.outbox.send(self.edit_progress, priority=NOTIFICATION,
+                                      chat_id=job.chat_id, bot=bot, job=job)
+
+
+    def edit_progress(self, chat_id, bot, job):
+        '''
+        Edit a job's acknowledgement to its latest stage; called by the outbox.
+        '''
+        with self.progress_lock:
+            text = job.stage_text
+        retried = False
+        try:
+            return bot.editMessageText(chat_id=chat_id,
+                                       message_id=job.message.result().message_id,
+                                       text="Report of {}: {}".format(job.name, text))
+        except error.RetryAfter:
+            # The outbox makes this very call again, showing the latest stage by then
+            retried = True
+            raise
         finally:
-            return 'instr'
+            if not retried:
+                self.progress_shown(chat_id, bot, job, text)
 
 
-    def execute_report(self, bot,  update, run):
+    def progress_shown(self, chat_id, bot, job, text):
+        '''
+        Mark a stage as shown (or given up on, if the edit failed), queueing one
+        more edit if a later stage was reached meanwhile.
+        '''
+        with self.progress_lock:
+            newer = job.stage_text != text
+            if not newer:
+                job.stage_text = None
+        if newer:
+            self.mainloop.outbox.send(self.edit_progress, priority=NOTIFICATION,
+                                      chat_id=chat_id, bot=bot, job=job)
+
+
+    def execute_report(self, bot,  update, run, job=None):
         # TODO see flows
         user = update.effective_user
-        runname = re.sub('Auto_[\w]*?_', '', run['resultsName'])
-        run_dir_id = run['id']
+        run_dir_id = run.id
+        stage = (lambda text: None) if job is None else job.stage
+        if run.has_library:
+            # Start downloading right away; the files are sent as they arrive
+            deadline, images, report = self.fetch_artifacts(run)
         
-        if run['analysismetrics'] is None:
-            bot.sendMessage(chat_id=user.id, text='No analysis metrics yet.')
-        else:
-            add_wells = int(run['analysismetrics']['total_wells']) - \
-                                int(run['analysismetrics']['excluded'])
-            bead = int(run['analysismetrics']['bead'])
-            live = int(run['analysismetrics']['live'])
-            lib = int(run['analysismetrics']['lib'])
-            libFinal = int(run['analysismetrics']['libFinal'])
-        if run['libmetrics'] is None:
-            bot.sendMessage(chat_id=user.id, text='No library metrics yet.')
+        if not run.has_analysis:
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text='No analysis metrics yet.')
+        if not run.has_library:
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text='No library metrics yet.')
         else:
-            key_signal = run['libmetrics']['aveKeyCounts']
-            mean_length = run['libmetrics']['q20_mean_alignment_length']
-            run_status = run['status']
-            loading_ok = (100 * bead/add_wells) >= int(run['experiment']['qcThresholds']['Bead Loading (%)'])
-            usable_ok = (100 * libFinal/lib) >= int(run['experiment']['qcThresholds']['Usable Sequence (%)'])
-            key_sig_ok = key_signal >=  int(run['experiment']['qcThresholds']['Key Signal (1-100)'])
-            string = ('[{}]\n{}\n'
-                      '{} Loading: {:.1%} {}\n'
-                      '{} Live: {:.1%}\n'
-                      '{} Library: {:.1%}\n'
-                      '{} Usable: {:.1%} {}\n'
-                      '{} Key signal: {} {}\n'
-                      'Mean length: {}\n'
-                      'Status: {} {}'.format(run_dir_id, runname, 
-                                          *pcsquares(bead/add_wells), mark(loading_ok), # Loading
-                                          *pcsquares(live/bead), # Live
-                                          *pcsquares(lib/live), # Library
-                                          *pcsquares(libFinal/lib), mark(usable_ok), # Usable
-                                          pcsquares(key_signal/100)[0], key_signal, mark(key_sig_ok),
-                                          mean_length,
-                                          run_status,
-                                          ['(at last monitoring)', ''][run_status=='Completed']))        
-            bot.sendMessage(chat_id=user.id, text=string)
-
-            for image_data in self.images:
-                image = self.get_image(run_dir_id, image_data[0])
+            if run.has_analysis:
+                string = self.render_report(run)
+                self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text=string)
+                stage("metrics sent, waiting for images...")
+
+            album = []
+            missing = []
+            for image_data, future in zip(self.images, images):
+                image = wait_for(future, deadline)
                 if image:
-                    bot.sendPhoto(chat_id=user.id, photo=open(image, 'rb'))
+                    key = (self.instr_id, run_dir_id, image_data[0],
+                           self.artifacts.digest(image))
+                    album.append((key, image, image_data[1].capitalize()))
                 else:
-                    bot.sendMessage(chat_id=user.id,
-                                    text="[no {} image]".format(image_data[1]))
-            self.report_link(bot, update, run)
-        bot.sendMessage(chat_id=user.id, text="End of report.")
+                    missing.append(image_data[1])
+            stage("images ready, sending...")
+            if album:
+                self.mainloop.uploads.send_album(bot, user.id, album)
+            if missing:
+                self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id,
+                                text="[no {} image]".format(', '.join(missing)))
+            if run.completed:
+                stage("images sent, waiting for the pdf...")
+            self.report_link(bot, update, run, report, deadline)
+        self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text="End of report.")
+        stage("done.")
+
+
+    def render_report(self, run):
+        '''
+        Return the metrics message of a run report.
+        Renderings are kept for up to REPORT_CACHE_SIZE runs, keyed by the run's
+        metrics, so unchanged runs are only formatted once.
+        :param run: a RunSummary with analysis and library metrics.
+        '''
+        # The run itself, not its hash, so that a collision never returns another run's text
+        key = (self.instr_id, run)
+        with self.reports_lock:
+            string = self.reports.get(key)
+            if string is not None:
+                self.reports.move_to_end(key)
+                self.report_hits += 1
+                return string
+            self.report_misses += 1
+        string = ('[{}]\n{}\n'
+                  '{} Loading: {:.1%} {}\n'
+                  '{} Live: {:.1%}\n'
+                  '{} Library: {:.1%}\n'
+                  '{} Usable: {:.1%} {}\n'
+                  '{} Key signal: {} {}\n'
+                  'Mean length: {}\n'
+                  'Status: {} {}'.format(run.id, run.name,
+                                      *pcsquares(run.loading), mark(run.loading_ok), # Loading
+                                      *pcsquares(run.live), # Live
+                                      *pcsquares(run.library), # Library
+                                      *pcsquares(run.usable), mark(run.usable_ok), # Usable
+                                      pcsquares(run.key_signal/100)[0], run.key_signal,
+                                      mark(run.key_signal_ok),
+                                      run.mean_length,
+                                      run.status,
+                                      ['(at last monitoring)', ''][run.completed]))
+        with self.reports_lock:
+            self.reports[key] = string
+            if len(self.reports) > REPORT_CACHE_SIZE:
+                self.reports.popitem(last=False)
+        return string
+
+
+    def fetch_artifacts(self, run):
+        '''
+        Start retrieving a run's images (and PDF, if complete) on the worker pool.
+        Return (deadline, [futures in the order of self.images], PDF future or None).
+        Downloads still going at the deadline are abandoned, freeing their worker.
+        :param run: the RunSummary read from the server by self.read_run().
+        '''
+        deadline = time.time() + self.fetch_timeout
+        images = [self.fetcher.submit(self.get_image, run.id, filename, run.completed,
+                                      deadline)
+                  for filename, _description in self.images]
+        report = None
+        if run.completed and self.cache_reports:
+            report = self.fetcher.submit(self.get_pdf, run.id, deadline)
+        elif run.completed and not self.mainloop.uploads.known(self.report_key(run.id)):
+            report = self.fetcher.submit(self.stream_pdf, run.id, deadline)
+        return deadline, images, report
+
+
+    # Server I/O is written as coroutines running on a shared event loop.
+    # The synchronous methods below are facades for the rest of the bot.
+    def run(self, coroutine_function, *args, **kwargs):
+        '''
+        Run a coroutine function on the event loop and wait for its result.
+        Without aiohttp, requests block anyway, so they run in the caller's thread.
+        '''
+        coroutine = coroutine_function(*args, **kwargs)
+        if self.loop is None:
+            return run_inline(coroutine)
+        return self.loop.run(coroutine)
+
 
     def read_monitor(self):
         '''
         Scrape data about current runs from the server and return it.
-        
+        Concurrent callers share a single request to the server.
+        '''
+        api_page = self.server+self.api+'monitorresult/'
+        return self.flights.do((self.instr_id, api_page), self.run, self.aread_monitor)
+
+
+    async def aread_monitor(self):
+        '''
+        Coroutine version of read_monitor().
+        Only self.list_fields are requested, page by page.
         '''
         
         flag = ''
         
         api_page = self.server+self.api+'monitorresult/'
+        params = {'limit': self.page_size,
+                  'offset': 0,
+                  'fields': ','.join(self.list_fields)}
+        if self.statuses:
+            params['status__in'] = ','.join(self.statuses)
         
         logging.info("Contacting: "+api_page)
+        runs = dict()
         try:
-            response = requests.get(api_page,
-                                         auth=self.auth, 
-                                         verify=False)
-            monitor_json = json.loads(response.text)
+            while True:
+                monitor_json = await self.aio.json(api_page, params=params,
+                                                   headers={'Accept-Encoding': 'gzip'})
+                objects = monitor_json['objects']
+                runs.update({obj['id']: RunSummary(self.with_experiment(obj))
+                             for obj in objects if obj})
+                meta = monitor_json.get('meta') or dict()
+                if not meta.get('next') or not objects:
+                    break
+                params['offset'] += len(objects)
             
         except:
             logging.warning("Server unreachable or bad auth.")
             flag = 'no_connection'
             return [None, flag]
         flag = 'ok'
-        # meta = monitor_json['meta']
-        runs = {obj['id']: obj for obj in monitor_json['objects'] if obj}
         return [runs, flag]
 
 
+    def with_experiment(self, obj):
+        '''
+        Return a run list object with the chip type and QC thresholds of its
+        run added, if the run's details were read before.
+        :param obj: a run as found in the monitorresult list.
+        '''
+        experiment = self.experiments.get(obj['id'])
+        if experiment is None or obj.get('experiment'):
+            return obj
+        return dict(obj, experiment=experiment)
+
+
+    def read_run(self, run_id):
+        '''
+        Return a RunSummary with the full data of a single run (including its
+        QC thresholds), or None if it could not be read.
+        Completed runs no longer change, so they are only read once.
+        :param run_id: the run's ID within the server.
+        '''
+        if run_id in self.details:
+            return self.details[run_id]
+        url = self.server+self.api+'monitorresult/{}/'.format(run_id)
+        try:
+            obj = self.flights.do((self.instr_id, url), self.run, self.aio.json, url,
+                                  headers={'Accept-Encoding': 'gzip'})
+            run = RunSummary(obj)
+        except:
+            logging.warning("Could not read run {} from {}.".format(run_id, self.server))
+            return None
+        # The details include the chip type and QC verdicts
+        experiment = obj.get('experiment') or dict()
+        self.experiments[run_id] = {key: experiment.get(key)
+                                    for key in ('chipType', 'qcThresholds')}
+        self.history.record(self.instr_id, [run])
+        if run.completed:
+            self.details[run_id] = run
+        return run
+
+
     def send_server_data(self, user, bot, complete = False):
         '''
         Send a "tick" to the user.
@@ -240,11 +803,19 @@ class Handler:
         :param update: the received update, automatically informed by python-telegram-bot.
         :param complete: if True, information is more verbose.
         '''
-        global text
-        response = requests.get(self.server+'configure/services/',
-                                auth=self.auth, 
-                                verify=False)
-        soup = BeautifulSoup(response.text, 'lxml')
+        retstring = self.run(self.aserver_data, complete)
+        if retstring is None:
+            retstring = "Warning: Could not retrieve VM info."
+        self.mainloop.outbox.send(bot.sendMessage, chat_id=user.id, text=retstring)
+
+
+    async def aserver_data(self, complete = False):
+        '''
+        Return the server's VM status as text, or None if it could not be read.
+        :param complete: if True, information is more verbose.
+        '''
+        page = await self.aio.text(self.server+'configure/services/')
+        soup = BeautifulSoup(page, 'lxml')
         table = soup.find_all('table') # new method name in BS4 is find_all
         if table:
             vm_info = table[0]
@@ -255,66 +826,168 @@ class Handler:
                 for head, body in zip(headtext, bodytext):
                     retlist.append('{}: {}'.format(head, body))
                 if complete:
-                    retstring = 'Server status:\n'+('\n'.join(retlist))
+                    return 'Server status:\n'+('\n'.join(retlist))
                 else:
-                    retstring = retlist[-1]
-                bot.sendMessage(chat_id=user.id, 
-                                text=retstring)
-                return
-        bot.sendMessage(chat_id=user.id,
-                        text="Warning: Could not retrieve VM info.")
-        return
+                    return retlist[-1]
+        return None
 
 
     # file retrieving methods
-    def get_image(self, run_id, filename):
+    def get_image(self, run_id, filename, completed=False, deadline=None):
         '''
         Attempt to retrieve an image file from the server.
         :param run_id: the run's ID within the server.
         :param filename: location of the image.
+        :param completed: True if the run is complete, so the image can no longer change.
+        :param deadline: time by which the download must be over (default: no limit).
         '''
         loc = 'report/{}/metal/{}'.format(run_id, filename)
         # Removing dirs from filename
-        destname = filename[filename.rfind('/')+1:]
-        dest = self.download_loc + '{}_{}'.format(run_id, destname)
-        return self.get_file(loc, dest)
+        artifact = filename[filename.rfind('/')+1:]
+        return self.get_file(loc, run_id, artifact, completed, deadline)
         
         
-    def get_pdf(self, run_id):
+    def get_pdf(self, run_id, deadline=None):
         '''
         Attempt to retrieve an PDF file from the server.
         :param run_id: the run's ID within the server.
+        :param deadline: time by which the download must be over (default: no limit).
+        '''
+        loc = self.report_loc.format(run_id)
+        # The report is only generated for completed runs
+        return self.get_file(loc, run_id, 'report.pdf', True, deadline)
+
+
+    def stream_pdf(self, run_id, deadline=None):
         '''
-        loc = 'report/latex/{}.pdf'.format(run_id)
-        dest = self.download_loc + '{}.pdf'.format(run_id)
-        return self.get_file(loc, dest)
+        Download a PDF report into a SpooledBuffer, bypassing the artifact cache.
+        Raise TooLarge, before downloading if possible, if Telegram would refuse it.
+        :param run_id: the run's ID within the server.
+        :param deadline: time by which the download must be over (default: no limit).
+        '''
+        buffer = SpooledBuffer()
+        try:
+            self.run(self.aio.stream, self.server+self.report_loc.format(run_id), buffer,
+                     deadline=deadline)
+        except:
+            buffer.close()
+            raise
+        return buffer
+
+
+    def report_key(self, run_id):
+        # Reports of completed runs never change, so no content hash is needed
+        return (self.instr_id, run_id, 'report.pdf')
 
 
-    def pdf(self, bot, update, report_id):
+    def pdf(self, bot, update, report_id, path):
         '''
         Deliver a PDF file to the user.
         '''
         user = update.effective_user
-        with open(self.download_loc + '{}.pdf'.format(report_id), 'rb') as document:
-            bot.sendDocument(chat_id=user.id, document=document)        
+        key = (self.instr_id, report_id, 'report.pdf', self.artifacts.digest(path))
+        self.mainloop.uploads.send(bot.sendDocument, 'document', key, path,
+                                   chat_id=user.id, filename='{}.pdf'.format(report_id))
+
+
+    def send_streamed_pdf(self, bot, chat_id, report_id, report=None):
+        '''
+        Deliver a PDF report straight from the server, unless its file_id is known.
+        :param bot: telegram.bot.Bot instance.
+        :param chat_id: the destination chat.
+        :param report_id: the run's ID within the server.
+        :param report: optional future for the SpooledBuffer, as started by self.fetch_artifacts();
+                       it gives up by itself at the fetch deadline.
+        '''
+        def source():
+            # Wait for the download started with the report rather than starting another
+            buffer = self.stream_pdf(report_id) if report is None else report.result()
+            return buffer.rewind()
+        try:
+            self.mainloop.uploads.send(bot.sendDocument, 'document', self.report_key(report_id),
+                                       source, chat_id=chat_id,
+                                       filename='{}.pdf'.format(report_id))
+        except TooLarge as exc:
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=chat_id, text=\
+                            "The pdf report ({:.0f} MB) is too large to send here. It is at {}".format(
+                            exc.size / 1024 / 1024, self.server+self.report_loc.format(report_id)))
+        except error.TelegramError:
+            raise
+        except Exception as exc:
+            logging.warning("Could not stream report {} from {}: {}".format(
+                            report_id, self.server, exc))
+            self.mainloop.outbox.send(bot.sendMessage, chat_id=chat_id, text=\
+                            "Run is complete, but I couldn't retrieve the pdf report.")
+        finally:
+            if report is not None:
+                # Uploading closes the buffer, but a known file_id may have been sent instead
+                report.add_done_callback(close_buffer)
 
         
-    def get_file(self, loc, dest):
+    def get_file(self, loc, run_id, artifact, completed=False, deadline=None):
         '''
-        Generic method to retrieve a file from the server and save it locally.
+        Generic method to retrieve a file from the server through the artifact cache.
+        Return the path to the local copy, or None if it could not be retrieved.
         :param loc: path to the file on the server.
-        :param dest: path to the locally saved copy.
+        :param run_id: the run's ID within the server.
+        :param artifact: name of the file in the cache.
+        :param completed: True if the file can no longer change on the server.
+        :param deadline: time by which the download must be over (default: no limit).
         '''
+        url = self.server+loc
         try:
-            response = requests.get(self.server+loc, auth=self.auth,
-                                    verify=False, stream=True)
-            with open(dest, 'wb') as out_file:
-                copyfileobj(response.raw, out_file)
-            return dest
+            # Concurrent callers wait for the same download instead of racing on the file
+            return self.flights.do((self.instr_id, url), self.run, self.aget_file,
+                                   loc, run_id, artifact, completed, deadline)
         except:
             return None
+
+
+    async def aget_file(self, loc, run_id, artifact, completed=False, deadline=None):
+        '''
+        Coroutine version of get_file(); exceptions are left to the caller.
+        '''
+        path, headers = self.artifacts.lookup(self.instr_id, run_id, artifact)
+        if path is not None:
+            return path
+        writer = self.artifacts.writer()
+        try:
+            status, response_headers = await self.aio.download(self.server+loc, headers,
+                                                               writer, deadline)
+        except:
+            writer.discard()
+            raise
+        if status == 304:
+            writer.discard()
+            return self.artifacts.revalidated(self.instr_id, run_id, artifact, completed)
+        return self.artifacts.commit(self.instr_id, run_id, artifact, writer,
+                                     response_headers, completed)
     
 
+def wait_for(future, deadline):
+    '''
+    Return the result of a future, or None if it is not ready by `deadline`.
+    :param future: a concurrent.futures.Future.
+    :param float deadline: time (as in time.time()) to stop waiting.
+    '''
+    try:
+        return future.result(timeout=max(0, deadline - time.time()))
+    except futures.TimeoutError:
+        return None
+
+
+def close_buffer(future):
+    '''
+    Close the SpooledBuffer held by a finished future, if any.
+    '''
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
 def get_tag_text(bs4tag, tagstring):
     '''
     Return text from a beautofulsoup tag and string.
@@ -333,8 +1006,7 @@ def collapse(text):
     https://stackoverflow.com/questions/1274906/collapsing-whitespace-in-a-string
     :param text: the text to be processed.
     '''
-    rex = re.compile(r'\W+')
-    return rex.sub(' ', text).strip()
+    return NON_WORD.sub(' ', text).strip()
 
 
 def pcsquares(value):
@@ -353,6 +1025,9 @@ def pcsquares(value):
 def mark(boolean):
     '''
     Return the unicode representation of a checked mark or an X.
-    :param bool boolean: The True / False information to represent visually.
+    :param bool boolean: The True / False information to represent visually
+                         (None, if unknown, is represented by nothing).
     '''
+    if boolean is None:
+        return ''
     return [u'\U0000274C', u'\U00002705'][boolean]
@@ -0,0 +1,109 @@
+'''
+Compact records of the runs read from a Torrent Server.
+'''
+
+import re
+
+# Run names are shown without the "Auto_<user>_" prefix added by the server
+RUN_PREFIX = re.compile(r'Auto_\w*?_')
+
+# qcThresholds keys, as found in a run's experiment
+LOADING_THRESHOLD = 'Bead Loading (%)'
+USABLE_THRESHOLD = 'Usable Sequence (%)'
+KEY_SIGNAL_THRESHOLD = 'Key Signal (1-100)'
+
+
+class RunSummary:
+    '''
+    The fields of a monitorresult object that the bot uses, with the metric
+    ratios and QC verdicts computed once when the record is built.
+    Ratios are None until the server has the corresponding metrics; QC
+    verdicts are also None when the run's thresholds were not read.
+    '''
+    __slots__ = ('id', 'name', 'status', 'timestamp', 'chip',
+                 'loading', 'live', 'library', 'usable', 'key_signal', 'mean_length',
+                 'loading_ok', 'usable_ok', 'key_signal_ok')
+
+    def __init__(self, obj):
+        '''
+        :param obj: a decoded monitorresult object.
+        '''
+        self.id = obj['id']
+        self.name = RUN_PREFIX.sub('', obj['resultsName'])
+        self.status = obj['status']
+        self.timestamp = obj.get('timeStamp')
+        experiment = obj.get('experiment') or dict()
+        self.chip = experiment.get('chipType')
+        analysis = obj.get('analysismetrics')
+        if analysis:
+            bead = int(analysis['bead'])
+            live = int(analysis['live'])
+            lib = int(analysis['lib'])
+            self.loading = ratio(bead, int(analysis['total_wells']) - int(analysis['excluded']))
+            self.live = ratio(live, bead)
+            self.library = ratio(lib, live)
+            self.usable = ratio(int(analysis['libFinal']), lib)
+        else:
+            self.loading = self.live = self.library = self.usable = None
+        library = obj.get('libmetrics')
+        if library:
+            self.key_signal = library['aveKeyCounts']
+            self.mean_length = library['q20_mean_alignment_length']
+        else:
+            self.key_signal = self.mean_length = None
+        thresholds = experiment.get('qcThresholds')
+        self.loading_ok = passes(self.loading, thresholds, LOADING_THRESHOLD, 100)
+        self.usable_ok = passes(self.usable, thresholds, USABLE_THRESHOLD, 100)
+        self.key_signal_ok = passes(self.key_signal, thresholds, KEY_SIGNAL_THRESHOLD, 1)
+
+
+    @property
+    def completed(self):
+        return self.status == 'Completed'
+
+
+    @property
+    def has_analysis(self):
+        return self.loading is not None
+
+
+    @property
+    def has_library(self):
+        return self.key_signal is not None
+
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+    def __eq__(self, other):
+        return isinstance(other, RunSummary) and self.values() == other.values()
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __hash__(self):
+        return hash(self.values())
+
+
+    def __repr__(self):
+        return 'RunSummary({}, {!r}, {!r})'.format(self.id, self.name, self.status)
+
+
+def ratio(part, whole):
+    return part / whole if whole else 0.0
+
+
+def passes(value, thresholds, key, scale):
+    '''
+    Return whether a metric reaches its QC threshold, or None if unknown.
+    :param value: the metric (a ratio, or a raw value).
+    :param thresholds: the run's qcThresholds dict, or None.
+    :param key: the threshold's key in `thresholds`.
+    :param scale: multiplies `value` to match the threshold's unit (100 for %).
+    '''
+    if value is None or not thresholds or key not in thresholds:
+        return None
+    return value * scale >= int(thresholds[key])
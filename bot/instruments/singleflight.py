@@ -0,0 +1,65 @@
+'''
+Coalescing of identical concurrent requests.
+'''
+
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Make sure only one call per key is in progress at any time.
+    Callers arriving while a call for the same key is running wait for it and
+    share its result (or its exception) instead of starting their own.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = dict() # {key: _Call}
+        self.upstream = 0 # calls actually executed
+        self.saved = 0 # calls answered by someone else's execution
+
+
+    def do(self, key, function, *args, **kwargs):
+        '''
+        Execute `function(*args, **kwargs)`, unless a call for `key` is already running.
+        :param key: any hashable identifying the resource, e.g. (instrument, url).
+        :param function: the callable doing the actual work.
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.saved += 1
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                self.upstream += 1
+                leader = True
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.done.set()
+
+
+    def stats(self):
+        with self.lock:
+            return {'upstream': self.upstream, 'saved': self.saved,
+                    'in_flight': len(self.calls)}
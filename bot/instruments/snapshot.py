@@ -0,0 +1,120 @@
+'''
+Background polling of instrument servers into versioned, shared snapshots.
+'''
+
+import logging, threading, time
+from collections import namedtuple
+from ..scheduler import shared_scheduler, IntervalTrigger, COALESCE
+
+POLL_JITTER = 0.1 # fraction of the interval added at random, so servers are not polled in step
+
+
+class Snapshot(namedtuple('Snapshot', ['version', 'runs', 'flag', 'taken', 'changed'])):
+    '''
+    An immutable view of the runs on a server.
+    `version` only changes when the runs change, at time `changed`; `flag` is the
+    outcome of the latest poll, and `taken` is when `runs` was last successfully read.
+    '''
+    __slots__ = ()
+
+    def age(self):
+        return time.time() - self.taken
+
+
+    def age_text(self):
+        '''
+        Return the age of the data in a short, human-readable form.
+        '''
+        seconds = int(self.age())
+        if seconds < 60:
+            return '{}s'.format(seconds)
+        minutes, seconds = divmod(seconds, 60)
+        if minutes < 60:
+            return '{}min {}s'.format(minutes, seconds)
+        hours, minutes = divmod(minutes, 60)
+        return '{}h {}min'.format(hours, minutes)
+
+
+class MonitorPoller:
+    '''
+    Periodically read the runs on a server and keep the latest snapshot,
+    so that any number of users can be answered from a single upstream query.
+    '''
+
+    def __init__(self, fetch, interval, name):
+        '''
+        :param fetch: callable returning [runs, flag], like Handler.read_monitor.
+        :param int interval: seconds between polls (0 disables background polling).
+        :param str name: used for the thread name and log messages.
+        '''
+        self.fetch = fetch
+        self.interval = interval
+        self.name = name
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.listeners = [] # called as listener(old, new) when the runs change
+        self.job = None # ScheduledJob on the shared scheduler
+
+
+    def start(self):
+        if self.interval <= 0 or self.job is not None:
+            return
+        self.job = shared_scheduler().schedule(IntervalTrigger(self.interval), self.poll,
+                                               name='poller-'+self.name,
+                                               jitter=self.interval * POLL_JITTER,
+                                               missed=COALESCE)
+
+
+    def stop(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+
+
+    def poll(self):
+        try:
+            self.refresh()
+        except Exception:
+            logging.exception("Polling {} failed.".format(self.name))
+
+
+    def refresh(self):
+        '''
+        Poll the server now and return the resulting snapshot.
+        '''
+        runs, flag = self.fetch()
+        with self.lock:
+            old = self.snapshot
+            changed = False
+            if runs is None:
+                # Keep serving the last good data, flagged with the failure
+                if old is None:
+                    self.snapshot = Snapshot(0, dict(), flag, 0, 0)
+                else:
+                    self.snapshot = old._replace(flag=flag)
+            elif old is not None and old.runs == runs:
+                self.snapshot = old._replace(flag=flag, taken=time.time())
+            else:
+                version = 1 if old is None else old.version + 1
+                now = time.time()
+                self.snapshot = Snapshot(version, runs, flag, now, now)
+                changed = True
+            snapshot = self.snapshot
+        if changed:
+            for listener in self.listeners:
+                try:
+                    listener(old, snapshot)
+                except Exception:
+                    logging.exception("Snapshot listener failed for {}.".format(self.name))
+        return snapshot
+
+
+    def get(self, max_age):
+        '''
+        Return the current snapshot, polling first if it is older than `max_age`.
+        :param int max_age: staleness bound, in seconds.
+        '''
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.age() > max_age:
+            snapshot = self.refresh()
+        return snapshot
@@ -0,0 +1,79 @@
+'''
+Buffers for files passed from an instrument server to Telegram without
+going through the artifact cache.
+'''
+
+import hashlib, tempfile
+
+UPLOAD_LIMIT = 50 * 1024 * 1024 # bytes, largest file a bot may send to Telegram
+SPOOL_SIZE = 8 * 1024 * 1024 # bytes kept in memory before spilling to an unnamed temporary file
+RESUME_ATTEMPTS = 3 # times an interrupted transfer is resumed
+
+
+class TooLarge(Exception):
+    '''
+    The file exceeds what Telegram accepts from bots.
+    '''
+    def __init__(self, size, limit=UPLOAD_LIMIT):
+        super().__init__('{} bytes, over the {} bytes limit'.format(size, limit))
+        self.size = size
+
+
+class SpooledBuffer:
+    '''
+    A bounded buffer for a single file on its way to Telegram.
+    Content stays in memory up to SPOOL_SIZE, then spills to an anonymous
+    temporary file that vanishes when closed; no named file is ever left behind.
+    '''
+
+    def __init__(self, limit=UPLOAD_LIMIT, spool=SPOOL_SIZE):
+        '''
+        :param limit: size in bytes above which writes raise TooLarge.
+        :param spool: size in bytes kept in memory.
+        '''
+        self.limit = limit
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool)
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+
+    def write(self, chunk):
+        if self.size + len(chunk) > self.limit:
+            raise TooLarge(self.size + len(chunk), self.limit)
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+
+    def restart(self):
+        '''
+        Drop the content, when a server answers a Range request with the whole file.
+        '''
+        self.file.seek(0)
+        self.file.truncate()
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+
+    def rewind(self):
+        '''
+        Return the underlying file object, positioned for reading.
+        '''
+        self.file.seek(0)
+        return self.file
+
+
+    def digest(self):
+        return self.hash.hexdigest()
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
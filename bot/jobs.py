@@ -0,0 +1,137 @@
+'''
+Background jobs for slow requests, such as run reports, so that dispatcher
+threads are free to answer other users right away.
+'''
+
+import logging, threading, time
+from concurrent import futures
+
+JOB_WORKERS = 4 # jobs running at once, for the whole bot
+MAX_PENDING = 32 # jobs queued or running before new ones are refused
+
+
+class Cancelled(Exception):
+    '''
+    Raised within a job by Job.stage() once the job has been cancelled.
+    '''
+
+
+class Job:
+    '''
+    One request running in the background for a chat.
+    The job's function reports its progress with self.stage(), which also stops
+    the job early (raising Cancelled) when a newer request replaced it.
+    '''
+
+    def __init__(self, chat_id, name, progress=None):
+        '''
+        :param chat_id: the chat that requested the job.
+        :param name: identifies the request, e.g. 'run 12 on PGM'.
+        :param progress: optional function called as progress(job, text) at each stage.
+        '''
+        self.chat_id = chat_id
+        self.name = name
+        self.progress = progress
+        self.cancelled = threading.Event()
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.message = None # Future of the message showing progress, if any
+        self.stage_text = None # latest stage waiting to be shown in self.message
+
+
+    def stage(self, text):
+        '''
+        Mark a stage as done, unless the job was cancelled.
+        :param text: a short description of the stage, shown to the user.
+        '''
+        if self.cancelled.is_set():
+            raise Cancelled(self.name)
+        if self.progress is not None:
+            self.progress(self, text)
+
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+
+class JobQueue:
+    '''
+    A bounded pool of worker threads running Jobs, keeping at most one job per
+    chat: a new request from a chat cancels the one it replaces.
+    '''
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=MAX_PENDING):
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.current = dict() # {chat_id: Job not yet finished}
+        self.pending = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.refused = 0
+        self.total_wait = 0.0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+    def submit(self, job, function, *args, **kwargs):
+        '''
+        Queue function(job, *args, **kwargs) to run on a worker thread.
+        If the chat already has a job with the same name, that one is kept instead;
+        any other job of the chat is cancelled.
+        :param job: a new Job.
+        :return: the job that will run, or None if the queue is full.
+        '''
+        with self.lock:
+            previous = self.current.get(job.chat_id)
+            if previous is not None and not previous.cancelled.is_set():
+                if previous.name == job.name:
+                    return previous
+                previous.cancel()
+            if self.pending >= self.max_pending:
+                self.refused += 1
+                return None
+            self.pending += 1
+            self.current[job.chat_id] = job
+        self.executor.submit(self._run, job, function, args, kwargs)
+        return job
+
+
+    def _run(self, job, function, args, kwargs):
+        job.started = time.time()
+        outcome = 'completed'
+        try:
+            if job.cancelled.is_set():
+                raise Cancelled(job.name)
+            function(job, *args, **kwargs)
+        except Cancelled:
+            outcome = 'cancelled'
+        except Exception:
+            outcome = 'failed'
+            logging.exception("Job {} failed.".format(job.name))
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                self.pending -= 1
+                if self.current.get(job.chat_id) is job:
+                    del self.current[job.chat_id]
+                setattr(self, outcome, getattr(self, outcome) + 1)
+                self.total_wait += job.started - job.submitted
+                self.total_time += job.finished - job.submitted
+                self.max_time = max(self.max_time, job.finished - job.submitted)
+
+
+    def stats(self):
+        with self.lock:
+            finished = max(self.completed + self.cancelled + self.failed, 1)
+            return {'pending': self.pending, 'completed': self.completed,
+                    'cancelled': self.cancelled, 'failed': self.failed,
+                    'refused': self.refused, 'mean_wait': self.total_wait / finished,
+                    'mean_time': self.total_time / finished, 'max_time': self.max_time}
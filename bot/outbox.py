@@ -0,0 +1,217 @@
+'''
+Rate-limited queue for everything the bot sends to Telegram.
+'''
+
+import logging, threading, time
+from concurrent.futures import Future
+from telegram import error
+
+# Priority classes; lower values are sent first
+INTERACTIVE = 0 # replies to a user's command or button
+NOTIFICATION = 1 # pushed updates and live status edits
+TICK = 2 # periodic uptime ticks
+
+SEND_WORKERS = 4 # threads talking to Telegram
+PER_CHAT_RATE = 1.0 # messages per second, per chat
+PER_CHAT_BURST = 3 # messages a chat may receive at once
+GLOBAL_RATE = 30.0 # messages per second, for the whole bot
+GLOBAL_BURST = 30
+MAX_MESSAGE_LENGTH = 4096 # characters, Telegram's limit for a text message
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+
+
+    def delay(self, now):
+        '''
+        Return how many seconds until a token is available (0 if one is).
+        '''
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Job:
+    def __init__(self, priority, seq, method, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.kwargs = kwargs
+        self.chat_id = kwargs.get('chat_id')
+        self.future = Future()
+        self.queued = time.time()
+
+
+class Outbox:
+    '''
+    Every message, photo or document goes through here. Jobs are sent by a few
+    worker threads in priority order, without exceeding Telegram's per-chat and
+    global rate limits; messages to the same chat keep their order within a
+    priority class. When Telegram answers "retry after", the chat is paused
+    and the job is retried.
+    '''
+
+    def __init__(self, workers=SEND_WORKERS):
+        self.cond = threading.Condition()
+        self.pending = [] # jobs sorted by (priority, seq)
+        self.seq = 0
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = dict() # {chat_id: TokenBucket}
+        self.paused = dict() # {chat_id: time when sending may resume}
+        self.busy = set() # chats with a job being sent right now
+        self.started = 0
+        self.sent = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        for number in range(workers):
+            threading.Thread(target=self._run, name='outbox-{}'.format(number),
+                             daemon=True).start()
+
+
+    def send(self, method, priority=INTERACTIVE, **kwargs):
+        '''
+        Queue a call to a python-telegram-bot sending method.
+        :param method: the bound method, e.g. bot.sendMessage.
+        :param int priority: INTERACTIVE, NOTIFICATION or TICK.
+        :param kwargs: the arguments to `method`; must include chat_id.
+        :return: a concurrent.futures.Future holding the method's result.
+        '''
+        with self.cond:
+            self.seq += 1
+            job = _Job(priority, self.seq, method, kwargs)
+            position = len(self.pending)
+            while position > 0 and (self.pending[position-1].priority > priority):
+                position -= 1
+            self.pending.insert(position, job)
+            self.cond.notify()
+        return job.future
+
+
+    def call(self, method, priority=INTERACTIVE, **kwargs):
+        '''
+        Like self.send(), but wait for the result (or raise the method's exception).
+        '''
+        return self.send(method, priority, **kwargs).result()
+
+
+    def _next(self, now):
+        '''
+        Return (job, 0) for the first job that may be sent now, or (None, seconds to wait).
+        Must be called with self.cond held.
+        '''
+        wait = None
+        blocked = set()
+        global_delay = self.global_bucket.delay(now)
+        for job in self.pending:
+            chat = job.chat_id
+            if chat in blocked or chat in self.busy:
+                continue
+            # Later jobs for this chat must wait for this one
+            blocked.add(chat)
+            bucket = self.chat_buckets.setdefault(chat, TokenBucket(PER_CHAT_RATE,
+                                                                    PER_CHAT_BURST))
+            delay = max(bucket.delay(now), self.paused.get(chat, 0) - now, global_delay)
+            if delay <= 0:
+                bucket.take()
+                self.global_bucket.take()
+                return job, 0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    job, wait = self._next(time.time())
+                    if job is not None:
+                        break
+                    self.cond.wait(wait)
+                self.pending.remove(job)
+                self.busy.add(job.chat_id)
+                waited = time.time() - job.queued
+                self.started += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            try:
+                result = job.method(**job.kwargs)
+            except error.RetryAfter as exc:
+                logging.warning("Telegram flood control: pausing chat {} for {}s.".format(
+                                job.chat_id, exc.retry_after))
+                with self.cond:
+                    self.retries += 1
+                    self.paused[job.chat_id] = time.time() + exc.retry_after
+                    self.pending.insert(0, job)
+                    self.busy.discard(job.chat_id)
+                    self.cond.notify_all()
+                continue
+            except Exception as exc:
+                logging.warning("Could not send to chat {}: {}".format(job.chat_id, exc))
+                job.future.set_exception(exc)
+            else:
+                job.future.set_result(result)
+            with self.cond:
+                self.sent += 1
+                self.busy.discard(job.chat_id)
+                self.cond.notify_all()
+
+
+    def stats(self):
+        with self.cond:
+            return {'queued': len(self.pending), 'sent': self.sent,
+                    'retries': self.retries, 'max_wait': self.max_wait,
+                    'mean_wait': self.total_wait / max(self.started, 1)}
+
+
+def split_messages(blocks, limit=MAX_MESSAGE_LENGTH, separator='\n\n'):
+    '''
+    Pack text blocks into as few messages as possible, each within `limit` characters.
+    A block longer than `limit` is cut into pieces.
+    :param blocks: list of strings, in the order they should appear.
+    :param int limit: maximum length of a message.
+    :param str separator: placed between blocks within a message.
+    '''
+    messages = []
+    current = ''
+    for block in blocks:
+        while len(block) > limit:
+            rest = block[limit:]
+            if current:
+                messages.append(current)
+                current = ''
+            messages.append(block[:limit])
+            block = rest
+        if not current:
+            current = block
+        elif len(current) + len(separator) + len(block) <= limit:
+            current = current + separator + block
+        else:
+            messages.append(current)
+            current = block
+    if current:
+        messages.append(current)
+    return messages
+
+
+def join_messages(notes, messages, limit=MAX_MESSAGE_LENGTH):
+    '''
+    Put short notes in front of already split messages, merging where they fit.
+    :param notes: list of strings to come first.
+    :param messages: list of message texts, as returned by split_messages().
+    '''
+    notes = split_messages(notes, limit, separator='\n')
+    if notes and messages and len(notes[-1]) + 1 + len(messages[0]) <= limit:
+        return notes[:-1] + [notes[-1] + '\n' + messages[0]] + messages[1:]
+    return notes + messages
@@ -0,0 +1,78 @@
+'''
+Routing of callback_data from inline keyboard buttons to the bot's methods.
+'''
+
+import threading
+from collections import Counter, namedtuple
+
+# action is called as action(bot, update, callback_data); guard, if not None, is
+# called the same way and returns whether the action will act on the press
+Route = namedtuple('Route', ['name', 'action', 'guard'])
+
+
+class RoutingTable:
+    '''
+    A precompiled map of callback_data to Routes. Fixed buttons are found with
+    one dict lookup; families of buttons sharing a prefix ('App_<username>',
+    'INSTRUMENT_01_Run_<id>'...) with at most two more, whatever the number
+    of buttons on screen. Tables are rebuilt, not changed, when a keyboard changes;
+    `version` tells which keyboards a table was built from.
+    '''
+
+    def __init__(self, version=None, hits=None):
+        '''
+        :param version: any value identifying the keyboards the table is built from.
+        :param hits: the hit counters of the table this one replaces, if any.
+        '''
+        self.version = version
+        self.exact = dict() # {callback_data: Route}
+        self.prefixes = dict() # {prefix, ending with '_': Route}
+        self.hits = Counter() if hits is None else hits # {route name: presses}
+        self.lock = threading.Lock()
+
+
+    def add(self, callback_data, name, action, guard=None):
+        self.exact[callback_data] = Route(name, action, guard)
+
+
+    def add_family(self, prefix, name, action, guard=None):
+        '''
+        Route every callback_data made of `prefix` and a suffix without underscores
+        (or, for prefixes without underscores but the last, any suffix).
+        '''
+        self.prefixes[prefix] = Route(name, action, guard)
+
+
+    def lookup(self, callback_data):
+        '''
+        Return the Route for a callback_data, or None.
+        '''
+        route = self.exact.get(callback_data)
+        if route is None:
+            # The prefix is either the first or all but the last '_'-separated part
+            route = (self.prefixes.get(callback_data[:callback_data.find('_') + 1]) or
+                     self.prefixes.get(callback_data[:callback_data.rfind('_') + 1]))
+        return route
+
+
+    def dispatch(self, bot, update, callback_data):
+        '''
+        Run the action routed to a callback_data, if any. Presses are only counted
+        as hits if the route's guard accepts them; the action still runs otherwise,
+        so that it can answer e.g. unauthorized users.
+        :return: the Route, or None.
+        '''
+        route = self.lookup(callback_data)
+        if route is None:
+            return None
+        if route.guard is None or route.guard(bot, update, callback_data):
+            with self.lock:
+                self.hits[route.name] += 1
+        route.action(bot, update, callback_data)
+        return route
+
+
+    def stats(self, top=10):
+        with self.lock:
+            return {'routes': len(self.exact) + len(self.prefixes),
+                    'hits': self.hits.most_common(top)}
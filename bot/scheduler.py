@@ -0,0 +1,284 @@
+'''
+A single thread running every periodic task of the bot from a priority queue.
+'''
+
+import heapq, itertools, logging, random, threading, time
+from concurrent import futures
+
+SCHEDULER_WORKERS = 4 # threads running due jobs, so a slow job does not hold up the others
+MISFIRE_GRACE = 60 # seconds a job may start late before it counts as missed
+CATCH_UP_LIMIT = 50 # missed runs replayed at most by a CATCH_UP job; older ones count as missed
+
+# What to do with runs missed while the bot was busy or the machine asleep
+COALESCE = 'coalesce' # run once now, then follow the schedule
+SKIP = 'skip' # drop missed runs and wait for the next one
+CATCH_UP = 'catch_up' # run every missed run (up to CATCH_UP_LIMIT), one after the other
+
+_shared_scheduler = None
+_shared_lock = threading.Lock()
+
+
+class IntervalTrigger:
+    '''
+    Fire every `seconds` seconds.
+    '''
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+    def next(self, after):
+        return after + self.seconds
+
+
+    def __repr__(self):
+        return 'every {}s'.format(self.seconds)
+
+
+class CronTrigger:
+    '''
+    Fire on the minutes matching a crontab-like specification, in local time:
+    "minute hour day-of-month month day-of-week" (0 = Sunday), where each field
+    is '*', a number, a range 'a-b', a step '*/n' or 'a-b/n', or a list of these.
+    Unlike cron, a time must match both the day of the month and the day of the week.
+    '''
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, spec):
+        '''
+        :param spec: e.g. '0 4 * * *' for every day at 04:00.
+        '''
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError("Cron specifications have 5 fields: {!r}".format(spec))
+        self.spec = spec
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+                parse_field(field, low, high) for field, (low, high) in zip(fields, self.RANGES)]
+
+
+    def next(self, after):
+        '''
+        Return the first matching minute after `after`, searching up to four years ahead.
+        '''
+        moment = (int(after) // 60 + 1) * 60
+        limit = moment + 4 * 366 * 24 * 60 * 60
+        while moment < limit:
+            local = time.localtime(moment)
+            if local.tm_mon not in self.months or local.tm_mday not in self.days or \
+               (local.tm_wday + 1) % 7 not in self.weekdays:
+                # Jump to the next local midnight
+                moment += (24 * 60 - local.tm_hour * 60 - local.tm_min) * 60
+            elif local.tm_hour not in self.hours:
+                moment += (60 - local.tm_min) * 60
+            elif local.tm_min not in self.minutes:
+                moment += 60
+            else:
+                return moment
+        raise ValueError("Cron specification never fires: {!r}".format(self.spec))
+
+
+    def __repr__(self):
+        return 'cron {!r}'.format(self.spec)
+
+
+def parse_field(field, low, high):
+    '''
+    Return the set of values allowed by one cron field.
+    '''
+    values = set()
+    for part in field.split(','):
+        part, _slash, step = part.partition('/')
+        if part == '*':
+            start, stop = low, high
+        elif '-' in part:
+            start, stop = (int(value) for value in part.split('-'))
+        else:
+            start = stop = int(part)
+            if step:
+                stop = high
+        if not low <= start <= stop <= high:
+            raise ValueError("Cron field out of range: {!r}".format(field))
+        values.update(range(start, stop + 1, int(step) if step else 1))
+    return values
+
+
+class ScheduledJob:
+    '''
+    A function called repeatedly by a Scheduler; returned by Scheduler.schedule().
+    '''
+
+    def __init__(self, scheduler, trigger, function, args, kwargs, name, jitter, missed):
+        self.scheduler = scheduler
+        self.trigger = trigger
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name
+        self.jitter = jitter
+        self.missed = missed
+        self.due = None # next time from the trigger, before jitter
+        self.cancelled = False
+        self.running = False
+        self.backlog = 0 # CATCH_UP runs due but not started yet
+        self.runs = 0
+        self.misses = 0
+
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+    def __repr__(self):
+        return 'ScheduledJob({!r}, {!r})'.format(self.name, self.trigger)
+
+
+class Scheduler:
+    '''
+    Runs every periodic job from one heap ordered by due time, whatever the
+    number of jobs: a single thread waits for the earliest one and hands it to
+    a small worker pool. A job never overlaps with itself; a run that comes due
+    while the previous one is still going counts as missed, or for CATCH_UP
+    jobs is queued to follow it.
+    '''
+
+    def __init__(self, workers=SCHEDULER_WORKERS, grace=MISFIRE_GRACE):
+        '''
+        :param workers: threads running due jobs.
+        :param grace: seconds a job may start late before its `missed` policy applies.
+        '''
+        self.grace = grace
+        self.cond = threading.Condition()
+        self.heap = [] # [(time, seq, job)]
+        self.seq = itertools.count()
+        self.jobs = set()
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self.max_delay = 0.0
+        # Totals, kept here so that cancelled jobs still count
+        self.runs = 0
+        self.misses = 0
+        self.thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self.thread.start()
+
+
+    def schedule(self, trigger, function, args=(), kwargs=None, name=None, jitter=0,
+                 missed=COALESCE, first=None):
+        '''
+        Call function(*args, **kwargs) whenever `trigger` fires.
+        :param trigger: an IntervalTrigger, a CronTrigger or any object with next(after).
+        :param name: shown in logs and statistics.
+        :param jitter: up to this many seconds are added at random to each run, so
+                       that jobs with the same schedule do not all fire at once.
+        :param missed: COALESCE, SKIP or CATCH_UP.
+        :param first: time of the first run (default: the trigger's first time from now).
+        :return: the ScheduledJob, which can be cancelled.
+        '''
+        job = ScheduledJob(self, trigger, function, args, kwargs or dict(),
+                           name or getattr(function, '__name__', 'job'), jitter, missed)
+        job.due = trigger.next(time.time()) if first is None else first
+        with self.cond:
+            self.jobs.add(job)
+            self._push(job)
+        return job
+
+
+    def cancel(self, job):
+        '''
+        Stop a job; a run already started is left to finish.
+        '''
+        with self.cond:
+            job.cancelled = True
+            self.jobs.discard(job)
+            # The heap entry is dropped when it comes up
+            self.cond.notify()
+
+
+    def _push(self, job):
+        when = job.due + random.uniform(0, job.jitter) if job.jitter else job.due
+        heapq.heappush(self.heap, (when, next(self.seq), job))
+        self.cond.notify()
+
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.cond.wait(None if not self.heap else self.heap[0][0] - time.time())
+                when, _seq, job = heapq.heappop(self.heap)
+                if job.cancelled:
+                    continue
+                now = time.time()
+                if job.missed == CATCH_UP:
+                    run = self._catch_up(job, now)
+                else:
+                    late = now - when > self.grace
+                    run = not job.running and not (late and job.missed == SKIP)
+                    if not run:
+                        self._missed(job, 1)
+                    # Skip over every run that is already past
+                    job.due = job.trigger.next(max(job.due, now))
+                if run:
+                    job.running = True
+                    self.max_delay = max(self.max_delay, now - when)
+                self._push(job)
+            if run:
+                self.executor.submit(self._call, job)
+
+
+    def _catch_up(self, job, now):
+        '''
+        Queue one run of a CATCH_UP job per fire time already past, up to
+        CATCH_UP_LIMIT, and move its due time to the next future one.
+        Return whether a run should start now (the others follow from _call()).
+        Must be called with self.cond held.
+        '''
+        due = job.trigger.next(job.due)
+        job.backlog += 1
+        while due <= now:
+            job.backlog += 1
+            due = job.trigger.next(due)
+        job.due = due
+        if job.backlog > CATCH_UP_LIMIT:
+            self._missed(job, job.backlog - CATCH_UP_LIMIT)
+            job.backlog = CATCH_UP_LIMIT
+        if job.running:
+            return False
+        job.backlog -= 1
+        return True
+
+
+    def _missed(self, job, count):
+        job.misses += count
+        self.misses += count
+
+
+    def _call(self, job):
+        while True:
+            try:
+                job.function(*job.args, **job.kwargs)
+            except Exception:
+                logging.exception("Scheduled job {} failed.".format(job.name))
+            with self.cond:
+                job.runs += 1
+                self.runs += 1
+                if job.cancelled or not job.backlog:
+                    job.running = False
+                    return
+                # Replay the next missed run right away
+                job.backlog -= 1
+
+
+    def stats(self):
+        with self.cond:
+            return {'jobs': len(self.jobs), 'runs': self.runs, 'misses': self.misses,
+                    'max_delay': self.max_delay}
+
+
+def shared_scheduler():
+    '''
+    Return the scheduler shared by the whole bot, starting it if needed.
+    '''
+    global _shared_scheduler
+    with _shared_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = Scheduler()
+        return _shared_scheduler
@@ -0,0 +1,161 @@
+'''
+Reuse of files already uploaded to Telegram.
+'''
+
+import json, logging, os, threading
+from contextlib import ExitStack
+from tempfile import NamedTemporaryFile
+from telegram import error, InputMediaPhoto
+
+
+class FileIdCache:
+    '''
+    Persistent map of (instrument, run id, artifact, content hash) to the
+    file_id Telegram returned when the file was first uploaded.
+    Sending a known file_id costs no upload at all, for any user.
+    '''
+
+    def __init__(self, path, outbox):
+        '''
+        :param path: the JSON file holding the map.
+        :param outbox: the Outbox all files are sent through.
+        '''
+        self.path = path
+        self.outbox = outbox
+        self.lock = threading.Lock()
+        self.file_ids = self.load()
+        self.hits = 0 # files sent by file_id
+        self.uploads = 0 # files actually uploaded
+
+
+    def send(self, method, field, key, source, **kwargs):
+        '''
+        Send a file with a python-telegram-bot method, reusing its file_id when possible.
+        If Telegram rejects a cached file_id, the file is uploaded again.
+        :param method: the bound sending method, e.g. bot.sendPhoto.
+        :param field: the keyword argument holding the file, e.g. 'photo'.
+        :param key: tuple (instrument, run id, artifact, content hash); the hash may
+                    be left out for files that never change.
+        :param source: local copy of the file, or a function returning an open binary
+                       file, only called if the file has to be uploaded.
+        :param kwargs: any other arguments to `method`, e.g. chat_id.
+        :return: the message sent.
+        '''
+        key = keystring(key)
+        file_id = self.file_ids.get(key)
+        if file_id is not None:
+            kwargs[field] = file_id
+            try:
+                message = self.outbox.call(method, **kwargs)
+                with self.lock:
+                    self.hits += 1
+                return message
+            except error.BadRequest as exc:
+                logging.info("Cached file_id for {} rejected ({}); uploading.".format(key, exc))
+        with open_source(source) as document:
+            kwargs[field] = document
+            message = self.outbox.call(method, **kwargs)
+        with self.lock:
+            self.uploads += 1
+            self.file_ids[key] = file_id_of(message, field)
+            self.save()
+        return message
+
+
+    def known(self, key):
+        return keystring(key) in self.file_ids
+
+
+    def send_album(self, bot, chat_id, items):
+        '''
+        Send photos as a single album (media group), reusing file_ids when possible.
+        If Telegram rejects any cached file_id, the whole album is uploaded again.
+        :param bot: telegram.bot.Bot instance.
+        :param chat_id: the destination chat.
+        :param items: list of (key, path, caption); see self.send() for `key`.
+        :return: list of messages sent.
+        '''
+        if len(items) == 1:
+            # Telegram albums need at least two items
+            key, path, caption = items[0]
+            return [self.send(bot.sendPhoto, 'photo', key, path,
+                              chat_id=chat_id, caption=caption)]
+        keys = [keystring(key) for key, _path, _caption in items]
+        cached = set(key for key in keys if key in self.file_ids)
+        if cached:
+            try:
+                with ExitStack() as stack:
+                    media = [InputMediaPhoto(media=self.file_ids.get(key) or \
+                                             stack.enter_context(open(path, 'rb')),
+                                             caption=caption)
+                             for key, (_key, path, caption) in zip(keys, items)]
+                    messages = self.outbox.call(bot.sendMediaGroup, chat_id=chat_id,
+                                                     media=media)
+                self.remember(keys, messages, cached)
+                return messages
+            except error.BadRequest as exc:
+                logging.info("Cached file_ids rejected ({}); uploading album.".format(exc))
+        with ExitStack() as stack:
+            media = [InputMediaPhoto(media=stack.enter_context(open(path, 'rb')),
+                                     caption=caption)
+                     for _key, path, caption in items]
+            messages = self.outbox.call(bot.sendMediaGroup, chat_id=chat_id, media=media)
+        self.remember(keys, messages, set())
+        return messages
+
+
+    def remember(self, keys, messages, cached):
+        '''
+        Store the file_ids of an album's photos and count hits and uploads.
+        :param cached: the keys that were sent by file_id.
+        '''
+        with self.lock:
+            self.hits += len(cached)
+            self.uploads += len(keys) - len(cached)
+            for key, message in zip(keys, messages):
+                self.file_ids[key] = file_id_of(message, 'photo')
+            self.save()
+
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return dict()
+        try:
+            with open(self.path) as ids_file:
+                return json.load(ids_file)
+        except ValueError:
+            logging.warning("Telegram file_id cache is corrupt; starting afresh.")
+            return dict()
+
+
+    def save(self):
+        with NamedTemporaryFile('w', dir=os.path.dirname(self.path) or '.',
+                                delete=False) as ids_file:
+            json.dump(self.file_ids, ids_file)
+        os.replace(ids_file.name, self.path)
+
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.file_ids), 'hits': self.hits,
+                    'uploads': self.uploads}
+
+
+def open_source(source):
+    return source() if callable(source) else open(source, 'rb')
+
+
+def keystring(key):
+    return '/'.join(str(part) for part in key)
+
+
+def file_id_of(message, field):
+    '''
+    Return the file_id of the file attached to a message.
+    :param message: telegram.Message returned when sending the file.
+    :param field: 'photo', 'document'...; for photos, the largest size is used.
+    '''
+    attachment = getattr(message, field)
+    if isinstance(attachment, list):
+        attachment = attachment[-1]
+    return attachment.file_id